@@ -0,0 +1,305 @@
+from fnmatch import fnmatchcase
+import argparse
+import contextlib
+import os
+import posixpath
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+from pyinfra.facts.server import Command
+from pyinfra.operations import files
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+from chaos_dots.roles.dotfiles import apply, dotfiles_new
+from chaos_dots.roles.dotfiles.localfs import openDigest
+from chaos_dots.roles.dotfiles.snapshot import (
+    buildSnapshotScripts,
+    describeDot,
+    DotfilesSnapshot,
+    FilesystemState,
+    snapshotRequest,
+)
+
+
+class MemoryFilesystem:
+    def __init__(self):
+        self.nodes = {'/': ['d', None]}
+        self.children = {'/': {}}
+        self.contents = {}
+        self.commits = {}
+        self.passwd = [('root', 0, '/bin/bash')]
+
+    def add(self, path, fileType='f', link=None, content=None):
+        parent = posixpath.dirname(path)
+        if parent not in self.nodes:
+            self.add(parent, 'd')
+        self.remove(path)
+        self.nodes[path] = [fileType, link]
+        self.children[parent][posixpath.basename(path)] = path
+        if fileType == 'd':
+            self.children[path] = {}
+        if content is not None:
+            self.contents[path] = content
+
+    def remove(self, path):
+        if path not in self.nodes:
+            return
+        for child in list(self.children.get(path, {}).values()):
+            self.remove(child)
+        self.children.pop(path, None)
+        self.contents.pop(path, None)
+        del self.nodes[path]
+        self.children[posixpath.dirname(path)].pop(posixpath.basename(path), None)
+
+    def walk(self, path, maxDepth, prunes=(), depth=1):
+        for name, childPath in self.children.get(path, {}).items():
+            if any(fnmatchcase(name, pattern) for pattern in prunes):
+                continue
+            yield childPath, self.nodes[childPath]
+            if depth < maxDepth and self.nodes[childPath][0] == 'd':
+                yield from self.walk(childPath, maxDepth, prunes, depth + 1)
+
+
+class FakeHost:
+    """Serves the dotfiles facts from a MemoryFilesystem and counts round trips."""
+
+    def __init__(self, name, fs):
+        self.name = name
+        self.data = {}
+        self.fs = fs
+        self.facts = 0
+        self.factBytes = 0
+
+    def get_fact(self, fact, *args, **kwargs):
+        self.facts += 1
+        lines = self.handlers[fact](self, *args)
+        self.factBytes += sum(len(line) + 1 for line in lines)
+        if fact is Command:
+            return "\n".join(lines)
+        return fact().process(lines)
+
+    def targetLine(self, path, node):
+        return f"T\t{path}\t{node[0]}\t{node[1] or ''}"
+
+    def sourceLines(self, sourcePath, depth, prunes):
+        for path, node in self.fs.walk(sourcePath, depth, prunes):
+            yield f"O\t{sourcePath}\t{path[len(sourcePath) + 1:]}\t{node[0]}"
+
+    def listTarget(self, targetPath, depth):
+        node = self.fs.nodes.get(targetPath)
+        resolved = node[1] if node and node[0] == 'l' else targetPath
+        for path, child in self.fs.walk(resolved, depth):
+            yield targetPath + path[len(resolved):], child
+
+    def fileLines(self, path):
+        if self.fs.nodes.get(path, [None])[0] != 'f':
+            return []
+        return [f"S\t{path}"] + [f"C\t{line}" for line in self.fs.contents.get(path, '').splitlines()]
+
+    def snapshotLines(self, request, index=0):
+        if index:
+            return []
+        fs = self.fs
+        lines = [f"P\t{name}\t{uid}\t{shell}" for name, uid, shell in fs.passwd]
+        for loc, user, stateFile, closedTargets in request.repos:
+            if fs.nodes.get(loc, [None])[0] == 'd':
+                lines.append(f"R\t{loc}")
+                lines.append(f"H\t{loc}\t{fs.commits.get(loc, '')}")
+                lines.extend(f"L\t{loc}\t{name}" for name in fs.children[loc])
+            lines.extend(self.fileLines(stateFile))
+            lines.extend(self.targetLine(path, fs.nodes[path]) for path in closedTargets if path in fs.nodes)
+        for sourcePath, depth, prunes in request.sources:
+            lines.extend(self.sourceLines(sourcePath, depth, prunes))
+        for targetPath, depth in request.targets:
+            lines.extend(self.targetLine(path, node) for path, node in self.listTarget(targetPath, depth))
+        for loc, sources, targets in request.digests:
+            listing = [line for source in sources for line in self.sourceLines(*source)]
+            listing.extend(
+                self.targetLine(path, node) for targetPath, depth in targets for path, node in self.listTarget(targetPath, depth)
+                if node[0] == 'l' and node[1].startswith(f"{loc}/")
+            )
+            lines.append(f"G\t{loc}\t{openDigest(listing)}")
+        for path in request.files:
+            lines.extend(self.fileLines(path))
+        return lines
+
+    def statLines(self, paths):
+        found = [(path, self.fs.nodes[path]) for path in paths if path in self.fs.nodes]
+        return ["".join(f"{path}\0{node[0]}\0{node[1] or ''}\0" for path, node in found)]
+
+    def commandLines(self, command):
+        return []
+
+    handlers = {DotfilesSnapshot: snapshotLines, FilesystemState: statLines, Command: commandLines}
+
+
+class FakeInventory:
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def get_active_hosts(self):
+        return self.hosts
+
+
+class FakeState:
+    def __init__(self, hosts):
+        self.inventory = FakeInventory(hosts)
+        self.ops = 0
+
+    def addOp(self, state, op, host=None, **kwargs):
+        self.ops += 1
+        fs = host.fs
+        if op is files.directory:
+            if kwargs['path'] not in fs.nodes:
+                fs.add(kwargs['path'], 'd')
+        elif op is files.put:
+            fs.add(kwargs['dest'], 'f', content=kwargs['src'].getvalue())
+        elif op is files.link:
+            fs.add(kwargs['path'], 'l', kwargs['target'])
+        elif op is apply.applyManifest:
+            applyEntries(fs, kwargs['manifest'])
+
+
+def applyEntries(fs, manifest):
+    for entry in manifest:
+        action = entry[0]
+        if action == 'remove':
+            fs.remove(entry[1])
+        elif action == 'backup':
+            fs.remove(entry[1])
+        elif action == 'mkdir' and entry[1] not in fs.nodes:
+            fs.add(entry[1], 'd')
+        elif action == 'link':
+            fs.add(entry[2], 'l', entry[1])
+
+
+def buildWorld(args, hostIndex):
+    fs = MemoryFilesystem()
+    dotfiles = []
+    for u in range(args.users):
+        user = f"user{u}"
+        fs.passwd.append((user, 1000 + u, '/bin/bash'))
+        fs.add(f"/home/{user}", 'd')
+        for r in range(args.repos):
+            name = f"repo{r}"
+            loc = f"/home/{user}/.dotfiles/chaos/{name}"
+            fs.add(loc, 'd')
+            fs.commits[loc] = f"{hostIndex:08x}{u:08x}{r:08x}".ljust(40, '0')
+            links = []
+            for k in range(args.links):
+                fs.add(f"{loc}/file{k}")
+                links.append({'from': f"file{k}", 'to': f".{name}_file{k}"})
+            if args.open_files:
+                for f in range(args.open_files):
+                    fs.add(f"{loc}/config/dir{f // 50}/file{f}.conf")
+                fs.add(f"{loc}/config/dir0/.file.swp")
+                links.append({'from': 'config', 'to': f".config/{name}", 'open': True, 'depth': 2, 'ignore': ['*.swp']})
+            dotfiles.append({
+                'user': user, 'url': f"https://example.invalid/{user}/{name}.git",
+                'batch': not args.no_batch, 'links': links,
+            })
+    return fs, dotfiles
+
+
+def writeChobolo(directory, name, dotfiles):
+    path = os.path.join(directory, f"{name}.yml")
+    with open(path, 'w') as choboloFile:
+        yaml.safe_dump({'dotfiles': dotfiles}, choboloFile, sort_keys=False)
+    return path
+
+
+def runScenario(hosts, choboloPath):
+    state = FakeState(hosts)
+    for host in hosts:
+        host.facts = host.factBytes = 0
+    dotfiles_new.add_op = apply.add_op = state.addOp
+    dotfiles_new._runPlans.clear()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for host in hosts:
+            dotfiles_new.runDotfiles(state, host, choboloPath, True)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'seconds': elapsed,
+        'facts': sum(host.facts for host in hosts),
+        'factBytes': sum(host.factBytes for host in hosts),
+        'ops': state.ops,
+        'peakMiB': peak / (1024 * 1024),
+    }
+
+
+def snapshotFacts(dotfiles, full):
+    dots = [(describeDot(dot), dot['links']) for dot in dotfiles]
+    return len(buildSnapshotScripts(snapshotRequest(dots, full=full)))
+
+
+def scenarioLimits(args, hosts, dotfiles):
+    repos = args.users * args.repos * hosts
+    linksPerRepo = args.links + args.open_files
+    applyOps = 3 if not args.no_batch else 2 + 2 * linksPerRepo
+    summary, listing = snapshotFacts(dotfiles, False), snapshotFacts(dotfiles, True)
+    return {
+        'fresh': {'facts': hosts * (summary + listing), 'ops': repos * applyOps},
+        'steady': {'facts': hosts * summary, 'ops': 0},
+        'drift': {'facts': hosts * (summary + listing + args.users), 'ops': repos * applyOps},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dotfile planning against an in-memory fake host.")
+    parser.add_argument('--hosts', type=int, default=1)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--repos', type=int, default=3, help="repos per user")
+    parser.add_argument('--links', type=int, default=20, help="closed links per repo")
+    parser.add_argument('--open-files', type=int, default=500, help="files in the open directory of each repo (0 to skip)")
+    parser.add_argument('--no-batch', action='store_true', help="measure the per-link operation path")
+    parser.add_argument('--max-seconds', type=float, help="fail if any scenario takes longer")
+    parser.add_argument('--max-peak-mib', type=float, help="fail if any scenario uses more memory")
+    args = parser.parse_args(argv)
+
+    worlds = [buildWorld(args, i) for i in range(args.hosts)]
+    hosts = [FakeHost(f"bench{i}", fs) for i, (fs, _) in enumerate(worlds)]
+    dotfiles = worlds[0][1]
+    drifted = [dict(dot, links=dot['links'][1:]) for dot in dotfiles]
+    limits = scenarioLimits(args, len(hosts), dotfiles)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        choboloPath = writeChobolo(directory, 'chobolo', dotfiles)
+        results['fresh'] = runScenario(hosts, choboloPath)
+        results['steady'] = runScenario(hosts, choboloPath)
+        results['drift'] = runScenario(hosts, writeChobolo(directory, 'drift', drifted))
+
+    print(f"{args.hosts} host(s) x {args.users} user(s) x {args.repos} repo(s) x "
+          f"{args.links} link(s) + {args.open_files} open file(s); timings include tracemalloc overhead")
+    print(f"{'scenario':<10}{'time (ms)':>12}{'facts':>8}{'fact KiB':>10}{'ops':>8}{'peak MiB':>10}")
+    failures = []
+    for name, result in results.items():
+        print(f"{name:<10}{result['seconds'] * 1000:>12.1f}{result['facts']:>8}{result['factBytes'] / 1024:>10.1f}"
+              f"{result['ops']:>8}{result['peakMiB']:>10.1f}")
+        for key, limit in limits[name].items():
+            if result[key] > limit:
+                failures.append(f"{name}: {key} {result[key]} exceeds {limit}")
+        if args.max_seconds is not None and result['seconds'] > args.max_seconds:
+            failures.append(f"{name}: took {result['seconds']:.2f}s, limit {args.max_seconds}s")
+        if args.max_peak_mib is not None and result['peakMiB'] > args.max_peak_mib:
+            failures.append(f"{name}: peak memory {result['peakMiB']:.1f} MiB, limit {args.max_peak_mib} MiB")
+
+    for failure in failures:
+        print(f"Regression: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ENTRY_POINTS = (
+    ('keys', 'chaos_dots.roles.dotfiles.chobolo', 'dotfiles_chobolo_keys'),
+    ('explain', 'chaos_dots.explanations.dotfiles.dots', 'DotfilesExplain'),
+    ('role', 'chaos_dots.roles.dotfiles.role', 'runDotfiles'),
+)
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+HEAVY_MODULES = ('pyinfra', 'omegaconf', 'yaml', 'jinja2', 'gevent')
+PROBE = """import importlib, json, sys, time
+start = time.perf_counter()
+getattr(importlib.import_module({module!r}), {attr!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'heavy': sorted(name for name in {heavy!r} if name in sys.modules)}}))
+"""
+
+
+def probeImport(module, attr):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, attr=attr, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module}:{attr} failed:\n{result.stderr}")
+    return json.loads(result.stdout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark import time of the plugin entry points.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=50.0, help="fail if any entry point imports slower")
+    args = parser.parse_args(argv)
+
+    print(f"{'entry':<10}{'best (ms)':>12}  heavy modules")
+    failures = []
+    for name, module, attr in ENTRY_POINTS:
+        runs = [probeImport(module, attr) for _ in range(args.repeat)]
+        best = min(run['seconds'] for run in runs)
+        heavy = runs[0]['heavy']
+        print(f"{name:<10}{best * 1000:>12.1f}  {', '.join(heavy) or '-'}")
+        if heavy:
+            failures.append(f"{name}: importing {module} loads {', '.join(heavy)}")
+        if best * 1000 > args.max_ms:
+            failures.append(f"{name}: import took {best * 1000:.1f}ms, limit {args.max_ms}ms")
+
+    for failure in failures:
+        print(f"Regression: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import time
+
+import yaml
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+from chaos_dots.roles.dotfiles.statefile import dumpState, parseState
+
+HOME = "/home/bench"
+
+
+def buildApplied(entries, filesPerEntry):
+    applied = []
+    for i in range(entries):
+        path = f".config/app{i}"
+        managedFiles = [f"{HOME}/{path}/dir{j // 50}/file{j}.conf" for j in range(filesPerEntry)]
+        applied.append({'source': f"app{i}", 'path': path, 'open': True, 'managed_files': managedFiles})
+    return applied
+
+
+def timeIt(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dotfile state file load/dump times.")
+    parser.add_argument('--entries', type=int, default=20)
+    parser.add_argument('--files', type=int, default=600, help="managed files per open entry")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    applied = buildApplied(args.entries, args.files)
+    total = sum(len(item['managed_files']) for item in applied)
+    print(f"{total} managed entries across {args.entries} open links")
+
+    legacyDump, legacy = timeIt(lambda: yaml.safe_dump({'applied': applied}, sort_keys=False), args.repeat)
+    legacyLoad, _ = timeIt(lambda: parseState(legacy, HOME), args.repeat)
+    compactDump, compact = timeIt(lambda: dumpState(HOME, applied, 'c' * 40, 'h' * 16, 'f' * 16), args.repeat)
+    compactLoad, loaded = timeIt(lambda: parseState(compact, HOME), args.repeat)
+
+    if loaded['applied'] != applied:
+        print("Round trip mismatch in compact state format.", file=sys.stderr)
+        return 1
+
+    print(f"{'format':<10}{'size (KiB)':>12}{'dump (ms)':>12}{'load (ms)':>12}")
+    for name, content, dumpTime, loadTime in (
+        ('yaml', legacy, legacyDump, legacyLoad),
+        ('v2', compact, compactDump, compactLoad),
+    ):
+        print(f"{name:<10}{len(content) / 1024:>12.1f}{dumpTime * 1000:>12.1f}{loadTime * 1000:>12.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
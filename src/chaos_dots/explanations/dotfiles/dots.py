@@ -6,7 +6,7 @@ class DotfilesExplain():
             'why': 'To keep all your configurations version-controlled in one or more git repositories. This makes your setup portable, reproducible, and easy to back up and sync across multiple machines.',
             'how': 'For each entry in the `dotfiles` list, the role clones the specified git repository. It then processes a list of `links` to create symlinks from the repository to your home directory, backing up any existing files. It also records its state to clean up old, unused links automatically.',
             'commands': ['git', 'ln', 'mv', 'rm'],
-            'files': ['~/.dotfiles/chaos/', '~/.local/state/chaos/'],
+            'files': ['~/.dotfiles/chaos/', '~/.local/state/chaos/', '/var/cache/chaos/dotfiles/'],
             'examples': [
                 {
                     'yaml': """dotfiles:
@@ -34,6 +34,7 @@ class DotfilesExplain():
             'what': 'An "open" link treats the source (`from`) as a folder and links all files and directories *inside* it to the destination folder (`to`).',
             'why': 'This is for managing application configs that are composed of multiple separate files within a single folder, such as `i3` or `polybar`. Instead of linking the parent folder itself, you link its individual contents.',
             'how': 'If your dotfiles repo has a folder `polybar/` containing `config.ini` and `launch.sh`, an open link from `polybar` to `.config/polybar` will result in two symlinks: `~/.config/polybar/config.ini` and `~/.config/polybar/launch.sh`.',
+            'technical': 'Set `depth` above `1` to descend into subfolders: folders above that depth are created as real directories and only the files inside them are linked, while anything at the depth limit is linked as a whole. `ignore` takes glob patterns matched against the path relative to `from` or its base name; ignored folders are not descended into. The whole source tree is enumerated in a single pass.',
             'equivalent': """# Equivalent of an open link from 'polybar' to '.config/polybar'
 ln -s ~/.dotfiles/chaos/dots/polybar/config.ini\\
 ~/.config/polybar/config.ini
@@ -61,5 +62,143 @@ ln -s ~/.dotfiles/chaos/dots/nvim ~/.config/nvim
             'what': 'The role saves a record of the links it manages for each repository to a state file located at `~/.local/state/chaos/dotfiles_<repo_name>`.',
             'why': 'To enable automatic and safe cleanup. When you remove a link from your Ch-aOS configuration, the role consults this state file and knows which symlinks to delete from your home directory on the next run. This prevents orphaned configuration files.',
             'how': 'After successfully applying the desired links, the role writes a list of all managed links to the state file. On subsequent runs, it compares this previous state with the new desired configuration to identify which links are now obsolete and should be removed.',
-            'technical': 'This stateful approach is key to making the dotfile management declarative. You only need to define what you want, and the role handles the logic for both creation and deletion.'
+            'technical': 'This stateful approach is key to making the dotfile management declarative. You only need to define what you want, and the role handles the logic for both creation and deletion. The state file also records the checked-out commit, a hash of the entry\'s `links`, a fingerprint of the managed targets and a digest of the `open` folders and of the links into the repository below their destinations. The first pass over a host only collects these (the digest is computed on the host), and folders and destinations are listed only for repositories where something no longer matches; the others are skipped without planning or uploading anything. The file is stored as versioned JSON lines, with the files of `open` links recorded relative to their destination folder; older YAML state files are still read and are rewritten in the new format on the next change.'
+        }
+
+    def explain_batch(self, detail_level='basic'):
+        """Explains the batched link application"""
+        return {
+            'concept': 'Batched Link Application (batch: true)',
+            'what': 'With `batch` enabled (the default), all removals, backups, directory creations and symlinks for one repository are written to a manifest and applied by a single operation.',
+            'why': 'Repositories with many `open` files would otherwise generate two operations per link, each with its own checks and execution overhead. Batching keeps the number of operations proportional to the number of repositories instead of the number of links.',
+            'how': 'The manifest is uploaded to `~/.local/state/chaos/.dotfiles_<repo_name>.manifest` and applied in one remote execution, which prints an `ok`/`failed` line for every entry. Set `batch: false` on a dotfiles entry to fall back to one operation per link.',
+        }
+
+    def explain_clone(self, detail_level='basic'):
+        """Explains how dotfile repositories are cloned and updated"""
+        return {
+            'concept': 'Repository Cloning and Updates',
+            'what': 'Missing repositories are cloned for every dotfiles entry on a host at once, and entries with `pull: true` are updated together by a single operation.',
+            'why': 'Cloning or pulling several large repositories one after another serialises all of their network I/O. Running them concurrently, and optionally with limited history, keeps deploys short.',
+            'how': 'Set `depth` to a positive number for a shallow clone and fetch, and `filter` (for example `blob:none`) for a partial clone that downloads file contents on demand. A `depth` of `0` and an empty `filter` keep the full history. With `shared: true`, the repository is mirrored once per host under `/var/cache/chaos/dotfiles/` and every user checkout of the same `url` borrows its objects from that mirror, so transfer and disk usage grow with distinct repositories instead of users.',
+            'technical': 'The shared mirror is a bare `git clone --mirror` fetched as root, so its `url` must be readable without per-user credentials. Checkouts reference it through git alternates (`--reference-if-able`) and pull from it locally; automatic garbage collection is disabled in the mirror so objects borrowed by checkouts are never pruned. Before pulling, the branch head is looked up with `git ls-remote` once per `url` and run from the control node (falling back to one batched lookup on the host); repositories whose checked-out commit already matches are not fetched at all (a fetch whose merge failed is retried on the next run). Clones, pulls and sparse updates that fail report the error message from git, and a repository that could not be cloned is shown as `failed` in the plan. Set `CHAOS_DOTFILES_REMOTE_CHECK` to `host` to only look up from the hosts, or `off` to always pull.',
+            'equivalent': """# Equivalent of depth: 1 and filter: blob:none
+git clone --branch main --depth 1 --filter=blob:none \\
+https://github.com/dexmachina/dots.git ~/.dotfiles/chaos/dots
+""",
+        }
+
+    def explain_plan(self, detail_level='basic'):
+        """Explains the consolidated dotfiles plan"""
+        return {
+            'concept': 'Consolidated Dotfiles Plan',
+            'what': 'Before changing anything, the role computes every removal, backup, directory and link for every active host and repository, prints a summary table, and asks for a single confirmation.',
+            'why': 'Multi-repository, multi-host deploys no longer stop once per repository for operator input, and the full plan can be reviewed, stored and applied later.',
+            'how': 'Set `CHAOS_DOTFILES_PLAN_OUT` to a file (or `-` for standard output) to write the plan as JSON, `CHAOS_DOTFILES_PLAN_ONLY=1` to stop after planning (repositories that still need cloning or a sparse checkout update are then only reported, and their links are planned on the next run), and `CHAOS_DOTFILES_PLAN_IN` to apply a previously written plan without planning again. A saved plan is refused when the chobolo file or a checked-out repository commit changed since it was written; set `CHAOS_DOTFILES_PLAN_FORCE=1` to apply it anyway.',
+            'equivalent': """CHAOS_DOTFILES_PLAN_OUT=dots.json CHAOS_DOTFILES_PLAN_ONLY=1 chaos apply dotfiles
+CHAOS_DOTFILES_PLAN_IN=dots.json chaos apply dotfiles
+""",
+        }
+
+    def explain_metrics(self, detail_level='basic'):
+        """Explains the dotfiles run metrics"""
+        return {
+            'concept': 'Dotfiles Run Metrics',
+            'what': 'An opt-in JSON report of where a dotfiles run spends its time: per host and per repository timings for each phase, the number of remote facts issued and bytes they returned, and the number of operations generated.',
+            'why': 'When a deploy is slow, the report shows whether the time goes to the host snapshot, cloning, stat calls, planning or operation execution, and it can be stored to track runs over time.',
+            'how': 'Set `CHAOS_DOTFILES_METRICS` to a file (or `-` for standard output). The report is written when the run finishes.',
+            'technical': 'Host phases are `chobolo`, `snapshot` (both snapshot passes), `bundle`, `remoteCheck`, `clone`, `sparse`, `noopCheck`, `render`, `removalStat`, `planTotal`, `ops` and `execute`; repository phases are `plan`, `ops` and `execute` (bundle uploads count towards their repository). All timings are wall-clock seconds. Operation execution is timed through pyinfra state callbacks, so it is only reported for operations that actually ran.',
+            'equivalent': """CHAOS_DOTFILES_METRICS=dots-metrics.json chaos apply dotfiles
+""",
+        }
+
+    def explain_local(self, detail_level='basic'):
+        """Explains the local fast path for dotfile facts"""
+        return {
+            'concept': 'Local Host Fast Path',
+            'what': 'When the target is `@local`, the role reads `/etc/passwd`, repository listings, state files and link targets directly with Python filesystem calls instead of running remote commands through `sudo`.',
+            'why': 'Workstation runs are the most common case, and spawning shells and `sudo` for every check costs far more than the checks themselves.',
+            'how': 'Nothing needs to be configured. If some path cannot be read by the user running Ch-aOS, the role falls back to the usual commands run through `sudo`. Set `CHAOS_DOTFILES_NO_LOCAL=1` to always use the commands.',
+            'technical': 'The direct reads produce the same snapshot records as the remote `find`/`awk` script, so planning is identical on both paths. The checked-out commit is read from `.git/HEAD` and the refs instead of running `git rev-parse`. Cloning, pulling and applying links still run as normal operations.',
+        }
+
+    def explain_backups(self, detail_level='basic'):
+        """Explains the backup store for replaced files"""
+        return {
+            'concept': 'Deduplicated Dotfile Backups',
+            'what': 'Files, folders and symlinks that are in the way of a link are moved into a per-user backup store at `~/.local/state/chaos/backups/` instead of being renamed to `<target>.bak_<timestamp>` next to the original.',
+            'why': 'Backups no longer litter the home directory, cannot collide when two conflicts happen in the same second, and identical content backed up on several runs is only stored once, so disk usage stays bounded on long-lived hosts.',
+            'how': 'Use `chaos-dots-backups list [path]` to see stored versions and `chaos-dots-backups restore <path> [--id ID] [--to DEST]` to bring one back (the newest by default). Old versions are pruned whenever a repository of that user changes: by default 5 versions are kept per path, for at most 90 days, within 256 MiB; override with `CHAOS_DOTFILES_BACKUP_KEEP`, `CHAOS_DOTFILES_BACKUP_DAYS` and `CHAOS_DOTFILES_BACKUP_MIB`.',
+            'technical': 'Files are stored under `objects/<sha256>` and hardlinked into the store when possible, folders are stored as a tar archive of their contents, and symlinks only record their target. The `index` file maps every backup id and time to its original path and object; pruning drops index lines and then deletes objects no index line references.',
+            'files': ['~/.local/state/chaos/backups/index', '~/.local/state/chaos/backups/objects/'],
+        }
+
+    def explain_conflicts(self, detail_level='basic'):
+        """Explains how conflicting link targets are resolved"""
+        return {
+            'concept': 'Cross-Repository Targets',
+            'what': 'All dotfiles entries of a user are planned together: every target path is owned by exactly one repository and link, and obsolete links are only removed when no repository still wants them.',
+            'why': 'Two repositories for the same user could otherwise fight over the same file, and cleaning up one repository could delete a link another repository had just created.',
+            'how': 'When two links point at the same target, the entry listed first in the `dotfiles` list wins and a warning names the other one. A repository that lost a conflict is planned again on every run, so it takes over the target as soon as the other entry releases it.',
+            'technical': 'Removals are computed once per user as the set of targets recorded in any repository\'s state file minus the targets claimed by the current plan, and the remaining paths are stat\'ed in a single call per user.',
+        }
+
+    def explain_watch(self, detail_level='basic'):
+        """Explains the dotfiles watch mode"""
+        return {
+            'concept': 'Dotfiles Watch Mode',
+            'what': 'A long-running command that watches your cloned dotfiles repositories and relinks them as soon as sources are added, removed or renamed, without a full Ch-aOS run.',
+            'why': 'New files in an `open` folder otherwise only get linked on the next deploy, which re-scans every host and repository.',
+            'how': 'Run `chaos-dots-watch <chobolo.yml>` as the user owning the dotfiles (for example from a systemd user service). It applies the current plan once, then waits for changes; bursts of changes are collected for `--debounce` seconds (0.5 by default) before relinking.',
+            'technical': 'Every folder of each checkout except `.git` is watched with inotify, and new folders are added to the watch as they appear. After a change only the affected repositories are replanned, with the same planner, backup store and state file as a normal run, and the resulting manifest is applied locally. If any change fails, the state file is left as it was, so the repository is planned again rather than recorded as applied. Watch mode never clones, pulls or changes sparse checkouts, and templated links keep their last rendered file until the next full run, which has the host data to render them. Repositories that are not cloned yet are ignored.',
+        }
+
+    def explain_template(self, detail_level='basic'):
+        """Explains templated dotfiles"""
+        return {
+            'concept': 'Templated Dotfiles',
+            'what': 'Links with `template: true` are rendered with Jinja2 and written to the target as a regular file instead of being symlinked.',
+            'why': 'Some configuration differs per host or per user (names, themes, paths) while the rest of the file is shared.',
+            'how': 'Mark the link with `template: true`. The template can use `user`, `home`, `host`, the host data and the `dotfiles` entry of the repository under `dotfile`; other chobolo keys are not visible, so editing them does not re-render templates. Templates cannot be `open` links.',
+            'technical': 'Rendering happens on the control node. The snapshot fact also returns the sha256 of every template source and target, and renders are cached under `~/.cache/chaos/dotfiles/templates` per host and repository by source hash and variables, so unchanged templates are neither fetched nor rendered again; entries a repository no longer uses are pruned after each render. A rendered file is only uploaded when its hash differs from the file on the host; files the host changed since the last run are moved to the backup store first. The state file records the rendered hash so later runs can tell edits from our own output.',
+        }
+
+    def explain_copy(self, detail_level='basic'):
+        """Explains copied dotfiles"""
+        return {
+            'concept': 'Copied Dotfiles',
+            'what': 'Links with `mode: copy` place a copy of the source file or folder at the target instead of a symlink.',
+            'why': 'Some programs refuse to read configuration through symlinks, or replace the link with a regular file when they save.',
+            'how': 'Set `mode: copy` on a link (the default is `link`). Copy mode cannot be combined with `open` or `template`.',
+            'technical': 'The snapshot fact hashes copy sources and targets in the same remote pass (folders get a hash over the sorted hashes of their files). Only targets whose hash differs from the source are copied, inside the same per-repository apply script as the links; targets changed on the host since the last run are backed up first. The hash is recorded in the state file, so a copy dropped from the chobolo is removed like a link.',
+        }
+
+    def explain_replay(self, detail_level='basic'):
+        """Explains offline capture and replay of dotfile facts"""
+        return {
+            'concept': 'Offline Capture and Replay',
+            'what': 'Records what the dotfiles role reads from each host into a small snapshot file, and plans a chobolo against those files later without connecting to any host.',
+            'why': 'Reviewing a chobolo change otherwise means planning against every live host over SSH.',
+            'how': 'Run once with `CHAOS_DOTFILES_CAPTURE=<dir>` (together with `CHAOS_DOTFILES_PLAN_ONLY=1` to leave the hosts untouched) to write `<dir>/<host>.snapshot.gz`. Then run `chaos-dots-replay <chobolo.yml> <dir>/*.snapshot.gz` to print the plan, or add `--base <old-chobolo.yml>` to print only the entries that differ per host and repository.',
+            'technical': 'A capture stores the same tab-separated records the snapshot fact returns (users, repository listings and commits, state files, open folder listings, target stats and hashes), plus the host data and template sources, gzip-compressed. While capturing, every closed link source and target is hashed too so copy links can be replayed. Replay answers the snapshot, stat and template facts from the file, turns the remote check off and plans `bundle: true` entries against the cached control node mirror without fetching it; paths that were never read are treated as absent and repositories that were not cloned yet are reported as cloning.',
+        }
+
+    def explain_sparse(self, detail_level='basic'):
+        """Explains sparse dotfile checkouts"""
+        return {
+            'concept': 'Sparse Dotfile Checkouts',
+            'what': 'With `sparse: true` a dotfiles repository is cloned without file contents up front and only the folders your links use are checked out.',
+            'why': 'A shared repository can hold configuration for many people or teams, while each user links only a few entries from it.',
+            'how': 'Set `sparse: true` on the dotfiles entry. Adding or removing links updates the checked-out folders on the next run; setting it back to `false` checks out the whole tree again.',
+            'technical': 'New clones use `--sparse` with a partial clone (`--filter=blob:none`, or the entry\'s own `filter`), so blobs are fetched only for checked-out paths. The cone is the set of top-level folders named by the `from` of each link (files at the top level are always present). The snapshot fact reports the current cone; repositories whose cone differs are updated with `git sparse-checkout set` (or `disable`) before planning, so newly referenced sources are linked in the same run.',
+        }
+
+    def explain_bundle(self, detail_level='basic'):
+        """Explains git bundle distribution of dotfile repositories"""
+        return {
+            'concept': 'Git Bundle Distribution',
+            'what': 'With `bundle: true` hosts never contact the git server: the control node fetches the repository and ships the new commits to each host as a git bundle.',
+            'why': 'Hundreds of hosts cloning and pulling the same repository load the git server, and hosts without access to it cannot be updated at all.',
+            'how': 'Set `bundle: true` on the dotfiles entry (with `pull: true` to keep it updated). The control node needs access to `url`; the hosts only need the usual Ch-aOS connection.',
+            'technical': 'The control node keeps one mirror per repository under `~/.cache/chaos/dotfiles/bundles` and fetches it once per run. For each host the bundle holds only the commits after the one checked out there (the commit also recorded in the state file), or the whole branch for a new clone; hosts on the same commit share one cached bundle. The bundle is uploaded to the state directory, fetched or cloned from there and deleted, and `origin` keeps pointing at `url`. Hosts already at the remote head get no upload.',
         }
@@ -0,0 +1,175 @@
+from io import StringIO
+import os
+import shlex
+
+from pyinfra.api import FileUploadCommand, operation
+from pyinfra.operations import files, server
+
+from .backups import STORE_FUNCTIONS
+from .metrics import add_op
+
+APPLY_SCRIPT = """status=0
+tab="$(printf '\\t')"
+while IFS="$tab" read -r action first second third; do
+    case "$action" in
+        remove) if [ -e "$first" ] || [ -L "$first" ]; then rm -rf -- "$first"; fi ;;
+        discard) discard "$first" "$second" "$third" ;;
+        backup) backup "$first" "$second" ;;
+        prune) prune "$first" "$second" ;;
+        mkdir) mkdir -p -- "$first" ;;
+        link) ln -sfn -- "$first" "$second" ;;
+        install) mv -f -- "$first" "$second" ;;
+        copy) rm -rf -- "$second.chaos-copy" && cp -a -- "$first" "$second.chaos-copy" && rm -rf -- "$second" && mv -- "$second.chaos-copy" "$second" ;;
+        *) false ;;
+    esac
+    if [ $? -eq 0 ]; then result=ok; else result=failed; status=1; fi
+    printf '%s\\t%s\\t%s\\t%s\\n' "$result" "$action" "$first" "$second"
+done < {manifest}
+rm -f {manifest}
+exit $status"""
+
+
+def buildManifest(pathsToRemove, links, fsState, store, dirs=(), writes=(), recorded=None):
+    removals, backups, mkdirs, symlinks = [], [], [], []
+    parentDirs, removed = set(), set()
+
+    for path in pathsToRemove:
+        if path in fsState:
+            removed.add(path)
+            if (recorded or {}).get(path):
+                removals.append(('discard', path, store, recorded[path]))
+            else:
+                removals.append(('remove', path))
+
+    for dirPath in dirs:
+        dirState = fsState.get(dirPath)
+        if dirState and dirState.is_dir:
+            continue
+        if dirState and dirPath not in removed:
+            backups.append(('backup', dirPath, store))
+        parentDirs.add(dirPath)
+        mkdirs.append(('mkdir', dirPath))
+
+    for sourceItem, targetPath in links:
+        targetState = fsState.get(targetPath)
+        if targetState and targetState.is_link and targetState.link == sourceItem:
+            continue
+        if targetState and targetPath not in removed:
+            backups.append(('backup', targetPath, store))
+        parentDir = os.path.dirname(targetPath)
+        if parentDir not in parentDirs:
+            parentDirs.add(parentDir)
+            mkdirs.append(('mkdir', parentDir))
+        symlinks.append(('link', sourceItem, targetPath))
+
+    for action, sourceItem, targetPath, ours in writes:
+        if fsState.get(targetPath) and not ours and targetPath not in removed:
+            backups.append(('backup', targetPath, store))
+        parentDir = os.path.dirname(targetPath)
+        if parentDir not in parentDirs:
+            parentDirs.add(parentDir)
+            mkdirs.append(('mkdir', parentDir))
+        symlinks.append((action, sourceItem, targetPath))
+
+    return removals + backups + mkdirs + symlinks
+
+
+def renderManifest(manifest):
+    return "".join("\t".join(entry) + "\n" for entry in manifest)
+
+
+@operation(is_idempotent=False)
+def applyManifest(manifest, manifestPath, uploads=None):
+    for stagePath, content in (uploads or {}).items():
+        yield FileUploadCommand(StringIO(content), stagePath)
+    yield FileUploadCommand(StringIO(renderManifest(manifest)), manifestPath)
+    yield STORE_FUNCTIONS + APPLY_SCRIPT.format(manifest=shlex.quote(manifestPath))
+
+
+def addManifestOps(state, host, user, manifest, uploads=None):
+    backups = {entry[1]: entry[2] for entry in manifest if entry[0] == 'backup'}
+
+    for entry in manifest:
+        action = entry[0]
+        if action == 'remove':
+            add_op(
+                state, server.shell, host=host,
+                name=f"Removing obsolete path: {entry[1]}",
+                commands=[f"rm -rf {shlex.quote(entry[1])}"],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'discard':
+            add_op(
+                state, server.shell, host=host,
+                name=f"Removing obsolete file (backing it up if edited): {entry[1]}",
+                commands=[f"{STORE_FUNCTIONS}discard {' '.join(shlex.quote(field) for field in entry[1:])}"],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'prune':
+            add_op(
+                state, server.shell, host=host,
+                name=f"Pruning {len(entry[2].split())} old backup(s) in {entry[1]}",
+                commands=[f"{STORE_FUNCTIONS}prune {shlex.quote(entry[1])} {shlex.quote(entry[2])}"],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'mkdir' and entry[1] in backups:
+            dirPath = entry[1]
+            add_op(
+                state, server.shell, host=host,
+                name=f"Backing up existing file and creating directory: {dirPath}",
+                commands=[
+                    f"{STORE_FUNCTIONS}backup {shlex.quote(dirPath)} {shlex.quote(backups[dirPath])}",
+                    f"mkdir -p {shlex.quote(dirPath)}",
+                ],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'mkdir':
+            add_op(
+                state, files.directory, host=host,
+                name=f"Ensuring directory exists: {entry[1]}",
+                path=entry[1], user=user, present=True, _sudo=True, _sudo_user=user
+            )
+        elif action == 'link' and entry[2] in backups:
+            sourceItem, targetPath = entry[1], entry[2]
+            add_op(
+                state, server.shell, host=host,
+                name=f"Backing up existing file and creating link: {targetPath}",
+                commands=[
+                    f"{STORE_FUNCTIONS}backup {shlex.quote(targetPath)} {shlex.quote(backups[targetPath])}",
+                    f"mkdir -p {shlex.quote(os.path.dirname(targetPath))}",
+                    f"ln -sfn {shlex.quote(sourceItem)} {shlex.quote(targetPath)}",
+                ],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'install':
+            stagePath, targetPath = entry[1], entry[2]
+            if targetPath in backups:
+                add_op(
+                    state, server.shell, host=host,
+                    name=f"Backing up existing file: {targetPath}",
+                    commands=[f"{STORE_FUNCTIONS}backup {shlex.quote(targetPath)} {shlex.quote(backups[targetPath])}"],
+                    _sudo=True, _sudo_user=user,
+                )
+            add_op(
+                state, files.put, host=host,
+                name=f"Rendering template: {targetPath}",
+                src=StringIO(uploads[stagePath]), dest=targetPath, user=user, _sudo=True, _sudo_user=user
+            )
+        elif action == 'copy':
+            sourceItem, targetPath = entry[1], entry[2]
+            commands = [f"{STORE_FUNCTIONS}backup {shlex.quote(targetPath)} {shlex.quote(backups[targetPath])}"] if targetPath in backups else []
+            add_op(
+                state, server.shell, host=host,
+                name=f"Copying dotfile: {sourceItem} -> {targetPath}",
+                commands=commands + [
+                    f"rm -rf {shlex.quote(targetPath)}",
+                    f"cp -a {shlex.quote(sourceItem)} {shlex.quote(targetPath)}",
+                ],
+                _sudo=True, _sudo_user=user,
+            )
+        elif action == 'link':
+            add_op(
+                state, files.link, host=host,
+                name=f"Creating link: {entry[2]} -> {entry[1]}",
+                path=entry[2], target=entry[1], user=user, _sudo=True, _sudo_user=user
+            )
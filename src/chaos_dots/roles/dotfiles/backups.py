@@ -0,0 +1,192 @@
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import time
+
+BACKUP_KEEP = 5
+BACKUP_MAX_DAYS = 90
+BACKUP_MAX_MIB = 256
+INDEX_FIELDS = ('id', 'time', 'kind', 'ref', 'size', 'path')
+
+STORE_FUNCTIONS = r"""backup_count=0
+backup() {
+    [ -e "$1" ] || [ -L "$1" ] || return 0
+    store="$2"
+    mkdir -p "$store/objects" || return 1
+    backup_count=$((backup_count + 1))
+    id="$(date +%s).$$.$backup_count"
+    if [ -L "$1" ]; then
+        kind=l; ref="$(readlink "$1")"; size=0
+    elif [ -d "$1" ]; then
+        kind=d; tmp="$store/objects/.tmp.$id"
+        tar -C "$(dirname "$1")" -cf "$tmp" "$(basename "$1")" || { rm -f "$tmp"; return 1; }
+        ref="$(sha256sum < "$tmp" | cut -d' ' -f1)"; size="$(wc -c < "$tmp")"
+        if [ -e "$store/objects/$ref" ]; then rm -f "$tmp"; else mv "$tmp" "$store/objects/$ref" || return 1; fi
+    else
+        kind=f; ref="$(sha256sum < "$1" | cut -d' ' -f1)"; size="$(wc -c < "$1")"
+        if [ ! -e "$store/objects/$ref" ]; then
+            ln "$1" "$store/objects/$ref" 2>/dev/null || cp -p "$1" "$store/objects/$ref" || return 1
+        fi
+    fi
+    rm -rf -- "$1" && printf '%s\t%s\t%s\t%s\t%s\t%s\n' "$id" "$(date +%s)" "$kind" "$ref" "$size" "$1" >> "$store/index"
+}
+discard() {
+    if [ -f "$1" ] && [ ! -L "$1" ]; then
+        hash="$(sha256sum < "$1" | cut -c1-64)"
+    elif [ -d "$1" ] && [ ! -L "$1" ]; then
+        hash="$(cd "$1" && find . -type f -print0 | LC_ALL=C sort -z | xargs -0 -r sha256sum | sha256sum | cut -c1-64)"
+    else
+        hash=
+    fi
+    if [ -n "$hash" ] && [ "$hash" = "$3" ]; then rm -rf -- "$1"; else backup "$1" "$2"; fi
+}
+prune() {
+    awk -F'\t' -v ids=" $2 " 'index(ids, " " $1 " ") == 0' "$1/index" > "$1/index.tmp" && mv "$1/index.tmp" "$1/index" || return 1
+    for object in "$1"/objects/*; do
+        [ -e "$object" ] || continue
+        cut -f4 "$1/index" | grep -qxF "${object##*/}" || rm -rf -- "$object"
+    done
+}
+"""
+
+
+def backupOptions():
+    return {
+        'keep': int(os.environ.get('CHAOS_DOTFILES_BACKUP_KEEP', BACKUP_KEEP)),
+        'maxDays': float(os.environ.get('CHAOS_DOTFILES_BACKUP_DAYS', BACKUP_MAX_DAYS)),
+        'maxBytes': int(float(os.environ.get('CHAOS_DOTFILES_BACKUP_MIB', BACKUP_MAX_MIB)) * 1024 * 1024),
+    }
+
+
+def storeDir(home):
+    return f"{home}/.local/state/chaos/backups"
+
+
+def indexPath(home):
+    return f"{storeDir(home)}/index"
+
+
+def parseIndex(content):
+    entries = []
+    for line in (content or "").splitlines():
+        fields = line.split('\t')
+        if len(fields) != len(INDEX_FIELDS) or not fields[1].isdigit() or not fields[4].isdigit():
+            continue
+        entry = dict(zip(INDEX_FIELDS, fields))
+        entry['time'], entry['size'] = int(entry['time']), int(entry['size'])
+        entries.append(entry)
+    return entries
+
+
+def expiredEntries(entries, options, now=None):
+    now = time.time() if now is None else now
+    cutoff = now - options['maxDays'] * 86400
+    expired, versions = set(), {}
+
+    # Index lines are appended in backup order, so the position breaks ties
+    # between backups taken within the same second.
+    newestFirst = [entry for _, entry in sorted(enumerate(entries), key=lambda item: (item[1]['time'], item[0]), reverse=True)]
+    for entry in newestFirst:
+        versions[entry['path']] = versions.get(entry['path'], 0) + 1
+        if versions[entry['path']] > options['keep'] or entry['time'] < cutoff:
+            expired.add(entry['id'])
+
+    kept = [entry for entry in entries if entry['id'] not in expired and entry['kind'] != 'l']
+    references, sizes = {}, {}
+    for entry in kept:
+        references[entry['ref']] = references.get(entry['ref'], 0) + 1
+        sizes[entry['ref']] = entry['size']
+    total = sum(sizes.values())
+    for entry in reversed(newestFirst):
+        if total <= options['maxBytes']:
+            break
+        if entry['id'] in expired or entry['kind'] == 'l':
+            continue
+        expired.add(entry['id'])
+        references[entry['ref']] -= 1
+        if not references[entry['ref']]:
+            total -= sizes[entry['ref']]
+
+    return [entry['id'] for entry in entries if entry['id'] in expired]
+
+
+def pruneEntry(home, indexContent, options=None):
+    expired = expiredEntries(parseIndex(indexContent), options or backupOptions())
+    if not expired:
+        return None
+    return ('prune', storeDir(home), " ".join(expired))
+
+
+def readIndex(store):
+    try:
+        with open(f"{store}/index") as indexFile:
+            return parseIndex(indexFile.read())
+    except FileNotFoundError:
+        return []
+
+
+def restoreEntry(store, entry, dest, force=False):
+    if os.path.lexists(dest):
+        if not force and not os.path.islink(dest):
+            raise FileExistsError(f"{dest} exists, move it away or use --force")
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        else:
+            os.remove(dest)
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+
+    if entry['kind'] == 'l':
+        os.symlink(entry['ref'], dest)
+    elif entry['kind'] == 'f':
+        shutil.copy2(f"{store}/objects/{entry['ref']}", dest)
+    else:
+        parent = os.path.dirname(dest) or '.'
+        with tarfile.open(f"{store}/objects/{entry['ref']}") as archive:
+            members = archive.getmembers()
+            top = members[0].name.split('/')[0] if members else ''
+            for member in members:
+                member.name = os.path.basename(dest) + member.name[len(top):]
+            archive.extractall(parent, members=members)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='chaos-dots-backups', description="List and restore dotfile backups.")
+    parser.add_argument('--store', default=storeDir(os.path.expanduser('~')))
+    commands = parser.add_subparsers(dest='command', required=True)
+    listCommand = commands.add_parser('list', help="list backed up versions")
+    listCommand.add_argument('path', nargs='?')
+    restoreCommand = commands.add_parser('restore', help="restore a backed up version")
+    restoreCommand.add_argument('path')
+    restoreCommand.add_argument('--id', help="version to restore (default: the newest)")
+    restoreCommand.add_argument('--to', help="restore to another path")
+    restoreCommand.add_argument('--force', action='store_true', help="replace an existing file or directory")
+    args = parser.parse_args(argv)
+
+    entries = readIndex(args.store)
+    if args.command == 'list':
+        for entry in entries:
+            if not args.path or entry['path'] == os.path.abspath(args.path):
+                stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))
+                print(f"{entry['id']}\t{stamp}\t{entry['kind']}\t{entry['size']}\t{entry['path']}")
+        return 0
+
+    path = os.path.abspath(args.path)
+    matches = [entry for entry in entries if entry['path'] == path and (not args.id or entry['id'] == args.id)]
+    if not matches:
+        print(f"No backup of {path}{f' with id {args.id}' if args.id else ''}.", file=sys.stderr)
+        return 1
+    entry = matches[-1]
+    dest = os.path.abspath(args.to) if args.to else path
+    try:
+        restoreEntry(args.store, entry, dest, args.force)
+    except (FileExistsError, OSError, tarfile.TarError) as error:
+        print(f"Could not restore {path}: {error}", file=sys.stderr)
+        return 1
+    print(f"Restored {path} ({entry['id']}) to {dest}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
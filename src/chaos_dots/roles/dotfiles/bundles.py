@@ -0,0 +1,111 @@
+import glob
+import hashlib
+import os
+import shlex
+import subprocess
+
+from .gitsync import gitCommand, remoteKey, sparseJob
+
+BUNDLE_CACHE = os.path.expanduser("~/.cache/chaos/dotfiles/bundles")
+GIT_TIMEOUT = 600
+
+_mirrorHeads = {}
+_bundlesUsed = set()
+
+
+def localGit(*args):
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0', GIT_SSH_COMMAND='ssh -o BatchMode=yes')
+    try:
+        result = subprocess.run(['git', *args], capture_output=True, text=True, env=env, timeout=GIT_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def offlineMode():
+    return bool(os.environ.get('CHAOS_DOTFILES_OFFLINE'))
+
+
+def controlMirror(url):
+    dotName = url.split('/')[-1].replace('.git', '')
+    return f"{BUNDLE_CACHE}/{dotName}-{hashlib.sha1(url.encode()).hexdigest()[:8]}.git"
+
+
+def mirrorHead(key):
+    if key not in _mirrorHeads:
+        url, branch = key
+        mirror = controlMirror(url)
+        if offlineMode():
+            fetched = mirror if os.path.isdir(mirror) else None
+        elif os.path.isdir(mirror):
+            fetched = localGit('-C', mirror, 'fetch', '-q', '--prune', 'origin')
+        else:
+            os.makedirs(BUNDLE_CACHE, exist_ok=True)
+            fetched = localGit('clone', '-q', '--mirror', url, mirror)
+        if fetched is None:
+            print(f"Warning: Could not {'find a cached mirror of' if offlineMode() else 'fetch'} {url} on the control node.")
+        _mirrorHeads[key] = localGit('-C', mirror, 'rev-parse', '-q', '--verify', f"refs/heads/{branch}^{{commit}}")
+    return _mirrorHeads[key]
+
+
+def buildBundle(key, base):
+    url, branch = key
+    head = mirrorHead(key)
+    if not head or head == base:
+        return None
+    mirror = controlMirror(url)
+    if base and localGit('-C', mirror, 'cat-file', '-e', f"{base}^{{commit}}") is None:
+        base = None
+    prefix = f"{mirror}.{hashlib.sha1(branch.encode()).hexdigest()[:8]}"
+    path = f"{prefix}.{head[:16]}-{base[:16] if base else 'full'}.bundle"
+    _bundlesUsed.add(path)
+    if not os.path.exists(path) and not offlineMode():
+        exclude = [f"^{base}"] if base else []
+        if localGit('-C', mirror, 'bundle', 'create', '-q', f"{path}.tmp", f"refs/heads/{branch}", *exclude) is None:
+            print(f"Warning: Could not create a bundle of {url} ({branch}).")
+            return None
+        os.replace(f"{path}.tmp", path)
+        for stale in glob.glob(f"{glob.escape(prefix)}.*.bundle"):
+            if stale not in _bundlesUsed:
+                os.remove(stale)
+    return path
+
+
+def bundleScript(info, dot, dest, clone):
+    branch = dot.get('branch', 'main')
+    user = info['user']
+    if clone:
+        steps = [gitCommand(user, 'clone', '-q', *(['--sparse'] if dot.get('sparse') else []), '--branch', branch, dest, info['loc'])]
+        steps.append(gitCommand(user, '-C', info['loc'], 'remote', 'set-url', 'origin', dot.get('url')))
+        if dot.get('sparse'):
+            steps.append(sparseJob(info, dot))
+    else:
+        steps = [
+            gitCommand(user, '-C', info['loc'], 'fetch', '-q', dest, f"refs/heads/{branch}"),
+            gitCommand(user, '-C', info['loc'], 'checkout', '-q', branch),
+            gitCommand(user, '-C', info['loc'], 'merge', '-q', '--ff-only', 'FETCH_HEAD'),
+        ]
+    return f"( {' && '.join(steps)} ); status=$?; rm -f {shlex.quote(dest)}; exit $status"
+
+
+def planBundles(gitJobs, snapshot):
+    bundles = []
+    for job in ('clone', 'pull'):
+        kept = []
+        for info, dot in gitJobs[job]:
+            if not dot.get('bundle'):
+                kept.append((info, dot))
+                continue
+            base = snapshot['commits'].get(info['loc']) if job == 'pull' else None
+            path = buildBundle(remoteKey(dot), base)
+            if path is None:
+                if job == 'pull' and mirrorHead(remoteKey(dot)) == base:
+                    print(f"Dotfiles repo '{info['name']}' for '{info['user']}' is at the remote {dot.get('branch', 'main')}, skipping bundle.")
+                continue
+            dest = f"{os.path.dirname(info['stateFile'])}/.dotfiles_{info['name']}.bundle"
+            bundles.append({
+                'user': info['user'], 'name': info['name'], 'loc': info['loc'], 'bundle': path, 'dest': dest,
+                'stateDir': os.path.dirname(info['stateFile']), 'script': bundleScript(info, dot, dest, job == 'clone'),
+            })
+        gitJobs[job] = kept
+    return bundles
@@ -0,0 +1,82 @@
+import base64
+import gzip
+import json
+import os
+
+from .templates import _sources, hostVars
+
+
+def captureDir():
+    return os.environ.get('CHAOS_DOTFILES_CAPTURE')
+
+
+def capturePath(directory, hostName):
+    return os.path.join(directory, f"{hostName.replace('/', '_')}.snapshot.gz")
+
+
+def dumpSnapshot(snapshot):
+    for name in sorted(snapshot['sysUsers']):
+        yield f"P\t{name}\t0\t/usr/bin/nologin"
+    for name in sorted(snapshot['users']):
+        yield f"P\t{name}\t1000\t/bin/bash"
+    for loc, names in sorted(snapshot['repos'].items()):
+        yield f"R\t{loc}"
+        yield f"H\t{loc}\t{snapshot['commits'].get(loc, '')}"
+        for name in sorted(names):
+            yield f"L\t{loc}\t{name}"
+        if loc in snapshot['sparse']:
+            yield f"K\t{loc}\t"
+            for name in sorted(snapshot['sparse'][loc]):
+                yield f"K\t{loc}\t/{name}/"
+        if loc in snapshot['tree']:
+            yield f"Y\t{loc}\t"
+            for name in sorted(snapshot['tree'][loc]):
+                yield f"Y\t{loc}\t{name}"
+    for path, content in sorted(snapshot['states'].items()):
+        yield f"S\t{path}"
+        for line in content.splitlines():
+            yield f"C\t{line}"
+    for sourcePath, entries in sorted(snapshot['open'].items()):
+        for relPath, fileType in entries:
+            yield f"O\t{sourcePath}\t{relPath}\t{fileType}"
+    for path, entry in sorted(snapshot['fs'].items()):
+        yield f"T\t{path}\t{entry.type}\t{entry.link or ''}"
+    for path, digest in sorted(snapshot['hashes'].items()):
+        yield f"Z\t{path}\t{digest}"
+
+
+def sourceLines(snapshot):
+    for path, digest in sorted(snapshot['hashes'].items()):
+        if digest in _sources:
+            yield f"B\t{path}\t{base64.b64encode(_sources[digest]).decode()}"
+
+
+def captureSnapshot(host, snapshot, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = capturePath(directory, host.name)
+    header = json.dumps({'host': host.name, 'data': hostVars(host)}, sort_keys=True, default=str)
+    with gzip.open(f"{path}.tmp", 'wt') as captured:
+        captured.write(f"D\t{header}\n")
+        for line in dumpSnapshot(snapshot):
+            captured.write(line + "\n")
+        for line in sourceLines(snapshot):
+            captured.write(line + "\n")
+    os.replace(f"{path}.tmp", path)
+    print(f"Captured dotfile facts for '{host.name}' to {path}.")
+    return path
+
+
+def readCapture(path):
+    header, lines, contents = {}, [], {}
+    with gzip.open(path, 'rt') as captured:
+        for line in captured:
+            line = line.rstrip('\n')
+            kind, _, rest = line.partition('\t')
+            if kind == 'D':
+                header = json.loads(rest)
+            elif kind == 'B':
+                sourcePath, _, data = rest.partition('\t')
+                contents[sourcePath] = base64.b64decode(data)
+            else:
+                lines.append(line)
+    return header, lines, contents
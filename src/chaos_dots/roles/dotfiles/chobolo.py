@@ -0,0 +1,138 @@
+from types import MappingProxyType
+import os
+
+dotfiles_chobolo_keys = [
+    {
+        "dotfiles": [
+            {
+                'user': "",
+                'url': "",
+                'branch': "main",
+                'pull': False,
+                'depth': 0,
+                'filter': "",
+                'shared': False,
+                'batch': True,
+                'sparse': False,
+                'bundle': False,
+                'links': [
+                    {
+                        'from': "",
+                        'to': "",
+                        'open': False,
+                        'depth': 1,
+                        'ignore': [],
+                        'template': False,
+                        'mode': "link"
+                    }
+                ]
+            }
+        ]
+    }
+]
+
+ENTRY_KEYS = dotfiles_chobolo_keys[0]['dotfiles'][0]
+LINK_KEYS = ENTRY_KEYS['links'][0]
+REQUIRED_ENTRY_KEYS = ('user', 'url')
+REQUIRED_LINK_KEYS = ('from',)
+LINK_MODES = ('link', 'copy')
+
+_choboloCache = {}
+
+
+def checkValue(where, value, template, errors):
+    if isinstance(template, bool):
+        if not isinstance(value, bool):
+            errors.append(f"{where}: expected true/false, got {value!r}")
+    elif isinstance(template, int):
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            errors.append(f"{where}: expected a non-negative integer, got {value!r}")
+    elif isinstance(template, str):
+        if not isinstance(value, str):
+            errors.append(f"{where}: expected a string, got {value!r}")
+    elif isinstance(template, list):
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            errors.append(f"{where}: expected a list of strings, got {value!r}")
+
+
+def normaliseSection(where, raw, template, required, errors):
+    if not isinstance(raw, dict):
+        errors.append(f"{where}: expected a mapping, got {raw!r}")
+        return None
+
+    for key in raw:
+        if key not in template:
+            errors.append(f"{where}.{key}: unknown key")
+    for key in required:
+        if not raw.get(key):
+            errors.append(f"{where}.{key}: required")
+
+    section = {}
+    for key, default in template.items():
+        if key == 'links':
+            continue
+        value = raw.get(key)
+        if value is None:
+            value = default
+        else:
+            checkValue(f"{where}.{key}", value, default, errors)
+        section[key] = tuple(value) if isinstance(value, list) else value
+    return section
+
+
+def normaliseDotfiles(rawDotfiles):
+    errors = []
+    if rawDotfiles is None:
+        return ()
+    if not isinstance(rawDotfiles, list):
+        raise ValueError(f"Invalid chobolo: dotfiles: expected a list, got {rawDotfiles!r}")
+
+    dotfiles = []
+    for i, rawDot in enumerate(rawDotfiles):
+        where = f"dotfiles[{i}]"
+        dot = normaliseSection(where, rawDot, ENTRY_KEYS, REQUIRED_ENTRY_KEYS, errors)
+        if dot is None:
+            continue
+        rawLinks = rawDot.get('links') or []
+        if not isinstance(rawLinks, list):
+            errors.append(f"{where}.links: expected a list, got {rawLinks!r}")
+            rawLinks = []
+        links = []
+        for j, rawLink in enumerate(rawLinks):
+            link = normaliseSection(f"{where}.links[{j}]", rawLink, LINK_KEYS, REQUIRED_LINK_KEYS, errors)
+            if link is not None:
+                if link['depth'] < 1:
+                    errors.append(f"{where}.links[{j}].depth: must be at least 1")
+                if link['template'] is True and link['open'] is True:
+                    errors.append(f"{where}.links[{j}].template: templates cannot be open links")
+                if link['mode'] not in LINK_MODES:
+                    errors.append(f"{where}.links[{j}].mode: expected one of {', '.join(LINK_MODES)}, got {link['mode']!r}")
+                elif link['mode'] == 'copy' and (link['open'] is True or link['template'] is True):
+                    errors.append(f"{where}.links[{j}].mode: copy cannot be combined with open or template")
+                links.append(MappingProxyType(link))
+        dot['links'] = tuple(links)
+        dotfiles.append(MappingProxyType(dot))
+
+    if errors:
+        raise ValueError("Invalid chobolo:\n  " + "\n  ".join(errors))
+    return tuple(dotfiles)
+
+
+def loadChobolo(choboloPath):
+    realPath = os.path.realpath(choboloPath)
+    stat = os.stat(realPath)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _choboloCache.get(realPath)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    from omegaconf import OmegaConf
+    chObolo = OmegaConf.to_container(OmegaConf.load(realPath), resolve=True)
+    dotfiles = normaliseDotfiles(chObolo.get('dotfiles') if isinstance(chObolo, dict) else None)
+    _choboloCache[realPath] = (stamp, dotfiles, chObolo if isinstance(chObolo, dict) else {})
+    return dotfiles
+
+
+def choboloVars(choboloPath):
+    loadChobolo(choboloPath)
+    return _choboloCache[os.path.realpath(choboloPath)][2]
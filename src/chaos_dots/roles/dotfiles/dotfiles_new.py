@@ -1,42 +1,61 @@
 from io import StringIO
-from typing import cast
-import yaml
-import time
 import os
 
-from pyinfra.operations import server, git, files
-from omegaconf import OmegaConf
-from pyinfra.api.operation import add_op
-from pyinfra.facts.files import Directory
-from pyinfra.facts.server import Command
+from pyinfra.operations import server, files
+
+from .apply import addManifestOps, applyManifest, buildManifest
+from .backups import indexPath, pruneEntry, storeDir
+from .bundles import planBundles
+from .capture import captureDir, captureSnapshot
+from .chobolo import choboloVars, dotfiles_chobolo_keys, loadChobolo
+from .gitsync import cloneRepos, pullScript, sparseUpdates, stalePulls, staleSparse
+from .localfs import isLocalHost
+from .metrics import add_op, getFact, startMetrics, timed
+from .plan import choboloMismatch, commitMismatch, confirmPlan, emitPlan, newRunPlan, planOptions, readPlan
+from .snapshot import (
+    collectSnapshot,
+    describeDot,
+    FilesystemState,
+    isStatted,
+    linkTargets,
+    localStat,
+    mergeSnapshot,
+    openDepth,
+    openIgnores,
+    openItems,
+    statChunks,
+)
+from .statefile import (
+    configHash,
+    dumpState,
+    isUnchanged,
+    linkFingerprint,
+    managedTargets,
+    openFingerprint,
+    readPrevState,
+)
+from .targets import buildTargetIndex, dropTargets, keepPrevious, keptClaims, planClaims, planRemovals
+from .templates import contextHash, renderTemplates, templateInputs
+
+_runPlans = {}
+
 
 def getFilesystemState(host, user, paths):
-    if not paths:
-        return {}
-
-    pathArgs = " ".join([f"'{p}'" for p in paths])
-    command = f"find {pathArgs} -maxdepth 0 -printf '%p\t%y\t%l\n' 2>/dev/null || true"
-    rawOutput = host.get_fact(Command, command, _sudo=True, _sudo_user=user)
-
-    fsState = {}
-    if rawOutput:
-        for line in rawOutput.strip().splitlines():
-            parts = line.split('\t')
-            path = parts[0]
-            fileType = parts[1]
-            linkTarget = parts[2] if len(parts) > 2 else ""
-            fsState[path] = {
-                "path": path,
-                "is_link": fileType == 'l',
-                "is_file": fileType == 'f',
-                "is_dir": fileType == 'd',
-                "link_target": linkTarget if fileType == 'l' else None,
-                "exists": True
-            }
-    return fsState
-
-
-def handleGitRepo(users, sysUsers, dot, host, state):
+    fsState = None
+    if isLocalHost(host):
+        try:
+            fsState = localStat(paths)
+        except PermissionError:
+            fsState = None
+    if fsState is None:
+        fsState = {}
+        for chunk in statChunks(paths):
+            fsState.update(getFact(host, FilesystemState, chunk, _sudo=True, _sudo_user=user) or {})
+    vanished = [path for path in paths if path not in fsState]
+    return fsState, vanished
+
+
+def handleGitRepo(users, sysUsers, dot, snapshot, gitJobs):
     user = dot.get('user')
     if user not in users:
         print(f"Skipping dotfile setup for user '{user}', as they do not exist on system.")
@@ -45,216 +64,395 @@ def handleGitRepo(users, sysUsers, dot, host, state):
         print(f"Skipping dotfile setup for system user '{user}', activity not allowed.")
         return None, None, None, None
 
-    dotName = dot.get('url').split('/')[-1].replace('.git', '')
-    dotLoc = f"/home/{user}/.dotfiles/chaos/{dotName}"
-    dotLocEx = host.get_fact(Directory, path=dotLoc)
-
-    branch = dot.get('branch', 'main')
-    pull = dot.get('pull', False)
-    should_run_git = not dotLocEx or pull
-    if should_run_git:
-        print(f"Cloning {dot.get('url')} to {dotLoc}.")
-        # HACK: Ensure the git repo is cloned before using git.repo to manage it
-        host.get_fact(Command, f"git clone '{dot.get('url')}' '{dotLoc}'", _sudo=True, _sudo_user=user)
-        add_op(
-            state, git.repo,
-            name=f"Ensuring dotfile repo state for '{user}'",
-            src=dot.get('url'),
-            dest=dotLoc,
-            branch=branch,
-            pull=pull,
-            user=user,
-        )
+    info = describeDot(dot)
+    dotName = info['name']
+    dotLoc = info['loc']
+    dotLocEx = dotLoc in snapshot['repos']
+
+    if not dotLocEx:
+        gitJobs['clone'].append((info, dot))
+    elif dot.get('pull', False):
+        gitJobs['pull'].append((info, dot))
     return dotLoc, dotName, dot, user
 
 
-def manageSingleLink(state, user, sourceItem, targetPath, fsState):
+def statRemovals(host, snapshot, removalsByUser):
+    for user, paths in removalsByUser.items():
+        missing = sorted({path for path in paths if not isStatted(snapshot, path)})
+        if not missing:
+            continue
+        fsState, vanished = getFilesystemState(host, user, missing)
+        snapshot['fs'].update(fsState)
+        snapshot['statted'].update(missing)
+        for path in vanished:
+            print(f"Info: Obsolete path '{path}' is already gone.")
+
+
+def planDotfile(info, desiredLinks, snapshot):
+    repoContents = snapshot['repos'].get(info['loc'], set())
+    links = []
+    dirs = []
+    missing = []
+    templates = []
+    written = []
+    writes = []
+    newRunState = []
+    plan = {
+        'links': links, 'dirs': dirs, 'missing': missing, 'applied': newRunState, 'templates': templates,
+        'written': written, 'writes': writes, 'kept': [], 'uploads': {},
+    }
+    previous = plan['previous'] = {
+        f"{info['home']}/{item.get('path')}": item.get('hash')
+        for item in readPrevState(snapshot, info).get('applied', []) if item.get('hash')
+    }
 
+    for link in desiredLinks:
+        source = link.get('from')
+        if source not in repoContents:
+            missing.append(source)
+            keepPrevious(info, plan, link, snapshot)
+            continue
 
-    targetState = fsState.get(targetPath)
+        destRel = link.get('to') or source
+        sourcePath, targetPath = linkTargets(info, link)
 
-    if targetState and targetState.get("exists") and \
-       (not targetState.get("is_link") or targetState.get("link_target") != sourceItem):
+        if link.get('template'):
+            templates.append((link, sourcePath, targetPath))
+        elif link.get('mode') == 'copy':
+            sourceHash = snapshot['hashes'].get(sourcePath)
+            if not sourceHash:
+                missing.append(source)
+                keepPrevious(info, plan, link, snapshot)
+                continue
+            targetState = snapshot['fs'].get(targetPath)
+            targetHash = snapshot['hashes'].get(targetPath) if targetState and targetState.type in ('f', 'd') else None
+            if targetHash != sourceHash:
+                ours = targetHash is not None and targetHash == previous.get(targetPath) or (
+                    targetState is not None and targetState.is_link and targetState.link == sourcePath
+                )
+                writes.append(('copy', sourcePath, targetPath, ours))
+            written.append((targetPath, sourcePath))
+            newRunState.append({
+                'source': source, 'path': source if destRel == '.' else destRel, 'open': False,
+                'mode': 'copy', 'hash': sourceHash, 'managed_files': [],
+            })
+        elif link.get('open'):
+            managedFiles = []
+            items, subDirs = openItems(snapshot['open'].get(sourcePath, []), openDepth(link), openIgnores(link))
+            dirs.extend(os.path.normpath(f"{targetPath}/{rel}") for rel in subDirs)
+            for item in items:
+                itemTarget = os.path.normpath(f"{targetPath}/{item}")
+                links.append((f"{sourcePath}/{item}", itemTarget))
+                managedFiles.append(itemTarget)
+            newRunState.append({'source': source, 'path': destRel, 'open': True, 'managed_files': managedFiles})
+        else:
+            links.append((sourcePath, targetPath))
+            newRunState.append({'source': source, 'path': source if destRel == '.' else destRel, 'open': False, 'managed_files': []})
+
+    return plan
+
+
+def recordedInputs(info, snapshot):
+    return {
+        f"{info['home']}/{item.get('path')}": item.get('input')
+        for item in readPrevState(snapshot, info).get('applied', []) if item.get('template')
+    }
 
-        timestamp = int(time.time())
-        backupPath = f"{targetPath}.bak_{timestamp}"
-        parentDir = os.path.dirname(targetPath)
 
-        commands = [
-            f"mv '{targetPath}' '{backupPath}'",
-            f"mkdir -p '{parentDir}'",
-            f"ln -sfn '{sourceItem}' '{targetPath}'"
-        ]
+def planHost(state, host, dotfiles, dirty=(), chobolo=None, watching=False):
+    planOnly = planOptions()['planOnly']
+    dots = [(describeDot(dotConfig), dotConfig.get('links', [])) for dotConfig in dotfiles]
+    indexes = sorted({indexPath(info['home']) for info, _ in dots})
+    summary = not captureDir()
+    with timed(host, 'snapshot'):
+        snapshot = collectSnapshot(host, dots, indexes, full=not summary)
 
-        add_op(
-            state,
-            server.shell,
-            name=f"Backing up existing file and creating link: {targetPath}",
-            commands=commands,
-            _sudo=True,
-            _sudo_user=user,
-        )
-    elif not (targetState and targetState.get("exists")):
-        parentDir = os.path.dirname(targetPath)
-        add_op(
-            state, files.directory,
-            name=f"Ensuring parent directory exists: {parentDir}",
-            path=parentDir, user=user, present=True, _sudo=True, _sudo_user=user
-        )
-        add_op(
-            state, files.link,
-            name=f"Creating link: {targetPath} -> {sourceItem}",
-            path=targetPath, target=sourceItem, user=user, _sudo=True, _sudo_user=user
-        )
+    active = []
+    gitJobs = {'clone': [], 'pull': []}
+    for dotConfig, (info, desiredLinks) in zip(dotfiles, dots):
+        dotLoc, dotName, dot, user = handleGitRepo(snapshot['users'], snapshot['sysUsers'], dotConfig, snapshot, gitJobs)
+        if not dotLoc:
+            continue
+        active.append((info, dot))
+    if watching:
+        gitJobs = {'clone': [], 'pull': []}
+
+    with timed(host, 'bundle'):
+        bundles = planBundles(gitJobs, snapshot)
+    with timed(host, 'remoteCheck'):
+        gitJobs['pull'] = stalePulls(host, gitJobs['pull'], snapshot)
+
+    fetchedMirrors = set()
+    with timed(host, 'clone'):
+        cloned, cloneErrors = (set(), {}) if planOnly else cloneRepos(host, gitJobs['clone'], fetchedMirrors)
+        if cloned:
+            mergeSnapshot(snapshot, collectSnapshot(host, [
+                (info, dot.get('links', [])) for info, dot in gitJobs['clone'] if info['loc'] in cloned
+            ]))
+    with timed(host, 'sparse'):
+        stale = [] if watching else staleSparse(active, snapshot)
+        pendingSparse = {info['loc'] for info, dot in stale} if planOnly else set()
+        resparsed = set() if planOnly else sparseUpdates(host, stale)
+        dirty = set(dirty) | resparsed | pendingSparse
+        if resparsed:
+            mergeSnapshot(snapshot, collectSnapshot(host, [
+                (info, dot.get('links', [])) for info, dot in active if info['loc'] in resparsed
+            ]))
+    hostPlan = {
+        'pull': [info['loc'] for info, dot in gitJobs['pull']],
+        'pullScript': pullScript(gitJobs['pull'], fetchedMirrors),
+        'bundles': bundles,
+        'repos': [],
+    }
 
+    with timed(host, 'noopCheck'):
+        unchanged = [
+            info for info, dot in active
+            if info['loc'] not in dirty and isUnchanged(
+                info, dot.get('links', []), snapshot,
+                recordedInputs(info, snapshot) if watching else
+                templateInputs(info, dot.get('links', []), snapshot, contextHash(host, chobolo, info)),
+            )
+        ]
+    active = [(info, dot) for info, dot in active if info not in unchanged]
 
-def runDotfiles(state, host, choboloPath, skip):
-    usersRawStr = host.get_fact(Command, "awk -F: '($3>=1000 && $7 ~ /(bash|zsh|fish|sh)$/){print $1}' /etc/passwd")
-    users = set(usersRawStr.strip().splitlines() if usersRawStr else []) - {'nobody'}
-    chObolo = OmegaConf.load(choboloPath)
-    sysUsersRaw = host.get_fact(Command, "awk -F: '($3<1000){print $1}' /etc/passwd")
-    sysUsers = set(sysUsersRaw.strip().splitlines() if sysUsersRaw else [])
-
-    chObolo = cast(dict, chObolo)
-    if not chObolo.get('dotfiles'):
-        print(f"\nNo dotfiles configured, skipping dotfile setup.")
-
-    for dotConfig in chObolo.get('dotfiles', []):
-        dotLoc, dotName, dot, user = handleGitRepo(users, sysUsers, dotConfig, host, state)
-        if not dotLoc:
+    if summary:
+        listing = [
+            (info, dot.get('links', [])) for info, dot in active
+            if info['loc'] in snapshot['repos'] and info['loc'] not in cloned | resparsed | pendingSparse
+        ]
+        if listing:
+            with timed(host, 'snapshot'):
+                mergeSnapshot(snapshot, collectSnapshot(host, listing))
+
+    plans = {}
+    for info, dot in active:
+        if info['loc'] in snapshot['repos'] and info['loc'] not in pendingSparse:
+            with timed(host, 'plan', repoKey(info)):
+                plans[info['loc']] = planDotfile(info, dot.get('links', []), snapshot)
+                if watching:
+                    for link, sourcePath, targetPath in plans[info['loc']]['templates']:
+                        keepPrevious(info, plans[info['loc']], link, snapshot)
+                    plans[info['loc']]['templates'] = []
+    with timed(host, 'render'):
+        renderTemplates(host, chobolo, [(info, plans[info['loc']]) for info, dot in active if info['loc'] in plans], snapshot)
+
+    activeInfos = [info for info, dot in active]
+    index, conflicts = buildTargetIndex([
+        (info, planClaims(plans[info['loc']]) if info['loc'] in plans else keptClaims(info, snapshot))
+        for info, links in dots if info in unchanged or info in activeInfos
+    ])
+    lost = {}
+    for info, targetPath, owner in conflicts:
+        print(f"Warning: '{targetPath}' is already managed by '{owner}', not linking it from '{info['name']}'.")
+        lost.setdefault(info['loc'], set()).add(targetPath)
+    for info, dot in active:
+        if info['loc'] in plans:
+            dropTargets(info, plans[info['loc']], lost.get(info['loc']))
+
+    removals = planRemovals([info for info, dot in active if info['loc'] in plans], index, snapshot)
+    removalsByUser = {}
+    for info, dot in active:
+        removalsByUser.setdefault(info['user'], []).extend(removals.get(info['loc'], []))
+    with timed(host, 'removalStat'):
+        statRemovals(host, snapshot, removalsByUser)
+    fsState = snapshot['fs']
+
+    for info in unchanged:
+        hostPlan['repos'].append({'user': info['user'], 'name': info['name'], 'status': 'unchanged'})
+
+    pruned = set()
+    for info, dot in active:
+        repoPlan = {'user': info['user'], 'name': info['name'], 'stateFile': info['stateFile']}
+        hostPlan['repos'].append(repoPlan)
+        if info['loc'] not in plans:
+            if info['loc'] in cloneErrors:
+                repoPlan.update({'status': 'failed', 'error': cloneErrors[info['loc']]})
+            else:
+                repoPlan['status'] = 'resparse' if info['loc'] in pendingSparse else 'cloning'
             continue
 
-        userHome = f"/home/{user}"
-        dot = cast(dict, dot)
-        desiredLinks = dot.get('links', [])
-
-        prevStateFile = f"{userHome}/.local/state/chaos/dotfiles_{dotName}"
-        prevStateContent = host.get_fact(Command, f"cat {prevStateFile} || true", _sudo=True, _sudo_user=user)
-        prevState = yaml.safe_load(prevStateContent) if prevStateContent else {"applied": []}
-
-        pathsToRemove = []
-        desiredSources = {link.get('from') for link in desiredLinks}
-        for item in prevState.get('applied', []):
-            if item.get('source') not in desiredSources:
-                if item.get('open'):
-                    pathsToRemove.extend(item.get('managed_files', []))
-                elif item.get('path'):
-                    pathsToRemove.append(f"{userHome}/{item.get('path')}")
-        dotLocExists = host.get_fact(Directory, path=dotLoc)
-        if not dotLocExists:
-            print(f"Info: Dotfile repo for '{dotName}' is being cloned. Links will be processed on the next run.")
+        plan = plans[info['loc']]
+        with timed(host, 'plan', repoKey(repoPlan)):
+            manifest = buildManifest(
+                removals[info['loc']], plan['links'], fsState, storeDir(info['home']), plan['dirs'], plan['writes'],
+                plan['previous'],
+            )
+            closed = set(managedTargets(info, [item for item in plan['applied'] if not item.get('open')]))
+            repoPlan.update({
+                'status': 'planned',
+                'batch': dot.get('batch', True),
+                'missing': plan['missing'],
+                'manifest': manifest,
+                'uploads': plan['uploads'],
+                'state': dumpState(
+                    info['home'],
+                    plan['applied'],
+                    commit=snapshot['commits'].get(info['loc']),
+                    configHash=None if info['loc'] in lost else configHash(dot.get('links', [])),
+                    fingerprint=linkFingerprint([pair for pair in (
+                        [(targetPath, sourceItem) for sourceItem, targetPath in plan['links']] +
+                        [(targetPath, None) for targetPath, sourcePath in plan['written']] +
+                        [(targetPath, fsState[targetPath].link if targetPath in fsState else None) for targetPath in plan['kept']]
+                    ) if pair[0] in closed]),
+                    openFingerprint=openFingerprint(info, dot.get('links', []), snapshot, manifest),
+                ),
+            })
+            if info['user'] not in pruned:
+                pruned.add(info['user'])
+                prune = pruneEntry(info['home'], snapshot['states'].get(indexPath(info['home'])))
+                if prune:
+                    repoPlan['manifest'].append(prune)
+    hostPlan['commits'] = {info['loc']: snapshot['commits'].get(info['loc']) or '' for info, links in dots}
+    if captureDir():
+        captureSnapshot(host, snapshot, captureDir())
+    return hostPlan
+
+
+def repoKey(repoPlan):
+    return f"{repoPlan['user']}/{repoPlan['name']}"
+
+
+def applyRepoPlan(state, host, repoPlan):
+    user = repoPlan['user']
+    dotName = repoPlan['name']
+    manifest = repoPlan['manifest']
+    stateFile = repoPlan['stateFile']
+    stateDir = os.path.dirname(stateFile)
+    add_op(
+        state, files.directory, host=host, name=f"Ensuring state directory exists: {stateDir}",
+        path=stateDir, user=user, present=True, _sudo=True, _sudo_user=user
+    )
+
+    if repoPlan['batch']:
+        if manifest:
+            add_op(
+                state, applyManifest, host=host,
+                name=f"Applying {len(manifest)} dotfile changes for '{user}': {dotName}",
+                manifest=manifest, manifestPath=f"{stateDir}/.dotfiles_{dotName}.manifest",
+                uploads=repoPlan.get('uploads'),
+                _sudo=True, _sudo_user=user
+            )
+    else:
+        addManifestOps(state, host, user, manifest, repoPlan.get('uploads'))
+
+    add_op(
+        state, files.put, host=host, name=f"Recording applied dotfile state to: {stateFile}",
+        src=StringIO(repoPlan['state']), dest=stateFile, user=user, _sudo=True, _sudo_user=user
+    )
+
+
+def applyBundle(state, host, bundle):
+    user = bundle['user']
+    add_op(
+        state, files.directory, host=host, name=f"Ensuring state directory exists: {bundle['stateDir']}",
+        path=bundle['stateDir'], user=user, present=True, _sudo=True, _sudo_user=user
+    )
+    add_op(
+        state, files.put, host=host, name=f"Uploading git bundle for '{user}': {bundle['name']}",
+        src=bundle['bundle'], dest=bundle['dest'], user=user, _sudo=True, _sudo_user=user
+    )
+    add_op(
+        state, server.shell, host=host, name=f"Updating dotfile repo from bundle: {bundle['loc']}",
+        commands=[bundle['script']], _sudo=True,
+    )
+
+
+def applyHostPlan(state, host, hostPlan):
+    if hostPlan.get('pullScript'):
+        with timed(host, 'ops'):
+            add_op(
+                state, server.shell, host=host,
+                name=f"Updating {len(hostPlan['pull'])} dotfile repo(s)",
+                commands=[hostPlan['pullScript']],
+                _sudo=True,
+            )
+
+    for bundle in hostPlan.get('bundles', []):
+        with timed(host, 'ops', repoKey(bundle)):
+            applyBundle(state, host, bundle)
+
+    for repoPlan in hostPlan['repos']:
+        if repoPlan['status'] == 'unchanged':
+            print(f"Dotfiles for user '{repoPlan['user']}': {repoPlan['name']} are up to date, skipping.")
+            continue
+        if repoPlan['status'] == 'failed':
+            print(f"Error: Dotfile repo '{repoPlan['name']}' for '{repoPlan['user']}' could not be cloned, skipping: {repoPlan['error']}")
+            continue
+        if repoPlan['status'] == 'cloning':
+            print(f"Info: Dotfile repo for '{repoPlan['name']}' is being cloned. Links will be processed on the next run.")
+            continue
+        if repoPlan['status'] == 'resparse':
+            print(f"Info: Sparse checkout of '{repoPlan['name']}' needs updating. It and its links will be processed on the next run.")
             continue
 
-        repoContentsRaw = host.get_fact(Command, f"ls -A1 {dotLoc}", _sudo=True, _sudo_user=user)
-        repoContents = set(repoContentsRaw.strip().splitlines() if repoContentsRaw else [])
+        with timed(host, 'ops', repoKey(repoPlan)):
+            applyRepoPlan(state, host, repoPlan)
 
-        pathsToStat = set(pathsToRemove)
-        openLinkSourceFiles = {}
 
-        for link in desiredLinks:
-            source = link.get('from')
-            if source not in repoContents:
-                continue
+def activeHosts(state, host):
+    try:
+        hosts = list(state.inventory.get_active_hosts())
+    except AttributeError:
+        hosts = []
+    if host.name not in {other.name for other in hosts}:
+        return [host]
+    return [host] + [other for other in hosts if other.name != host.name]
 
-            destRel = link.get('to') or source
 
-            if link.get('open'):
-                targetBaseDir = f"{userHome}/{destRel}"
-                sourceDir = f"{dotLoc}/{source}"
-                openFilesRaw = host.get_fact(Command, f"ls -A1 {sourceDir} 2>/dev/null || true", _sudo=True, _sudo_user=user)
-                openFiles = openFilesRaw.strip().splitlines() if openFilesRaw else []
-                openLinkSourceFiles[source] = openFiles
-                for item in openFiles:
-                    pathsToStat.add(os.path.normpath(f"{targetBaseDir}/{item}"))
-            else:
-                link_path = source if destRel == '.' else destRel
-                pathsToStat.add(f"{userHome}/{link_path}")
-
-        fsState = getFilesystemState(host, user, list(pathsToStat))
-
-        print(f"\nProcessing dotfiles for user '{user}': {dotName}")
-        print(f"Links to process: ")
-        for link in desiredLinks:
-            print(f"  Linked from: {link.get('from')}")
-            print(f"  Linked to: {link.get('to')}")
-            print(f"  Open.\n") if link.get('open') else print(f"  Not open.\n")
-        print(f"Paths to remove: ") if pathsToRemove else print("No paths to remove.")
-        for rem in pathsToRemove:
-            print(f"{rem}")
-        confirm = "y" if skip else input("\nIs This correct (Y/n)? ")
-
-        if confirm.lower() in ["y", "yes", "", "s", "sim"]:
-            for path in pathsToRemove:
-                if fsState.get(path, {}).get('exists'):
-                    add_op(
-                        state,
-                        server.shell,
-                        name=f"Removing obsolete path: {path}",
-                        commands=[f"rm -rf '{path}'"],
-                        _sudo=True,
-                        _sudo_user=user,
-                    )
-
-            newRunState = []
-            for link in desiredLinks:
-                source = link.get('from')
-                if source not in repoContents:
-                    print(f"Warning: Source path '{source}' not in repo, skipping.")
-                    continue
-
-                destRel = link.get('to') or source
-
-                if link.get('open'):
-                    managedFiles = []
-                    targetBaseDir = f"{userHome}/{destRel}"
-                    sourceFiles = openLinkSourceFiles.get(source, [])
-
-                    for item in sourceFiles:
-                        sourceItem = f"{dotLoc}/{source}/{item}"
-                        targetPath = os.path.normpath(f"{targetBaseDir}/{item}")
-                        manageSingleLink(state, user, sourceItem, targetPath, fsState)
-
-                        managedFiles.append(targetPath)
-
-                    newRunState.append({'source': source, 'path': destRel, 'open': True, 'managed_files': managedFiles})
-                else:
-                    sourceItem = f"{dotLoc}/{source}"
-                    link_path = source if destRel == '.' else destRel
-                    targetPath = f"{userHome}/{link_path}"
-                    manageSingleLink(state, user, sourceItem, targetPath, fsState)
-
-                    newRunState.append({'source': source, 'path': link_path, 'open': False, 'managed_files': []})
-
-            stateDir = f"{userHome}/.local/state/chaos"
-            stateFile = f"{stateDir}/dotfiles_{dotName}"
-            conf = OmegaConf.create({'applied': newRunState})
-            yamlContent = OmegaConf.to_yaml(conf)
+def stalePlan(state, host, choboloPath, pending):
+    mismatch = choboloMismatch(pending, choboloPath)
+    if mismatch:
+        return mismatch
+    dots = [(describeDot(dotConfig), dotConfig.get('links', [])) for dotConfig in loadChobolo(choboloPath)]
+    for planned in activeHosts(state, host):
+        if planned.name in pending['hosts']:
+            with timed(planned, 'snapshot'):
+                snapshot = collectSnapshot(planned, dots, full=False)
+            mismatch = commitMismatch(planned.name, pending['hosts'][planned.name], snapshot['commits'])
+            if mismatch:
+                return mismatch
+    return None
 
-            add_op(
-                state, files.directory, name=f"Ensuring state directory exists: {stateDir}",
-                path=stateDir, user=user, present=True, _sudo=True, _sudo_user=user
-            )
-            add_op(
-                state, files.put, name=f"Recording applied dotfile state to: {stateFile}",
-                src=StringIO(yamlContent), dest=stateFile, user=user, _sudo=True, _sudo_user=user
-            )
 
-dotfiles_chobolo_keys = [
-    {
-        "dotfiles": [
-            {
-                'user': "",
-                'url': "",
-                'branch': "main",
-                'pull': False,
-                'links': [
-                    {
-                        'from': "",
-                        'to': "",
-                        'open': False
-                    }
-                ]
-            }
-        ]
-    }
-]
+def runDotfiles(state, host, choboloPath, skip):
+    options = planOptions()
+    startMetrics(state)
+    runPlan = _runPlans.setdefault((id(state), os.path.realpath(choboloPath)), newRunPlan(choboloPath))
+
+    if host.name not in runPlan['hosts']:
+        stale = None
+        if options['input']:
+            pending = readPlan(options['input'])
+            if host.name not in pending['hosts']:
+                print(f"No saved dotfiles plan for host '{host.name}', skipping dotfile setup.")
+                return
+            stale = stalePlan(state, host, choboloPath, pending)
+            if stale and options['force']:
+                print(f"Warning: Saved dotfiles plan {options['input']} is stale ({stale}), applying it anyway.")
+                stale = None
+            elif stale:
+                print(f"Error: Saved dotfiles plan {options['input']} is stale ({stale}), not applying it. "
+                      "Plan again, or set CHAOS_DOTFILES_PLAN_FORCE to apply it anyway.")
+        else:
+            with timed(host, 'chobolo'):
+                dotfiles = loadChobolo(choboloPath)
+                chobolo = choboloVars(choboloPath)
+            if not dotfiles:
+                print(f"\nNo dotfiles configured, skipping dotfile setup.")
+                return
+            pending = newRunPlan(choboloPath)
+            for planned in activeHosts(state, host):
+                if planned.name not in runPlan['hosts']:
+                    with timed(planned, 'planTotal'):
+                        pending['hosts'][planned.name] = planHost(state, planned, dotfiles, chobolo=chobolo)
+
+        emitPlan(pending, options)
+        confirmed = not options['planOnly'] and not stale and confirmPlan(pending, skip)
+        for hostName, hostPlan in pending['hosts'].items():
+            hostPlan['confirmed'] = confirmed
+            runPlan['hosts'].setdefault(hostName, hostPlan)
+
+    hostPlan = runPlan['hosts'][host.name]
+    if hostPlan.get('confirmed'):
+        applyHostPlan(state, host, hostPlan)
@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import shlex
+import subprocess
+
+from pyinfra.facts.server import Command
+
+from .metrics import getFact
+
+MIRROR_ROOT = "/var/cache/chaos/dotfiles"
+LS_REMOTE_TIMEOUT = 20
+
+_remoteHeads = {}
+
+
+def gitCommand(user, *args):
+    prefix = ["sudo", "-u", shlex.quote(user), "-H", "git"] if user else ["git"]
+    return " ".join(prefix + [shlex.quote(str(arg)) for arg in args])
+
+
+def mirrorPath(dot):
+    url = dot.get('url')
+    dotName = url.split('/')[-1].replace('.git', '')
+    return f"{MIRROR_ROOT}/{dotName}-{hashlib.sha1(url.encode()).hexdigest()[:8]}.git"
+
+
+def mirrorJob(url, path):
+    q = shlex.quote
+    return (
+        f"if [ -d {q(path)} ]; then {gitCommand(None, '-C', path, 'fetch', '-q', 'origin')}; "
+        f"else mkdir -p {q(MIRROR_ROOT)} && "
+        f"{gitCommand(None, 'clone', '-q', '--mirror', '-c', 'gc.auto=0', '-c', 'gc.pruneExpire=never', url, path)} && "
+        f"chmod -R a+rX {q(path)}; fi"
+    )
+
+
+def mirrorJobs(entries, fetched):
+    jobs = {}
+    for info, dot in entries:
+        if not dot.get('shared'):
+            continue
+        path = mirrorPath(dot)
+        if path not in fetched and path not in jobs:
+            jobs[path] = mirrorJob(dot.get('url'), path)
+    fetched.update(jobs)
+    return list(jobs.items())
+
+
+def cloneArgs(dot):
+    args = ['--branch', dot.get('branch', 'main')]
+    if dot.get('sparse'):
+        args.append('--sparse')
+    if dot.get('shared'):
+        return args + ['--reference-if-able', mirrorPath(dot)]
+    if dot.get('depth'):
+        args += ['--depth', int(dot.get('depth'))]
+    if dot.get('filter') or dot.get('sparse'):
+        args.append(f"--filter={dot.get('filter') or 'blob:none'}")
+    return args
+
+
+def cloneJob(info, dot):
+    job = gitCommand(info['user'], 'clone', '-q', *cloneArgs(dot), dot.get('url'), info['loc'])
+    if dot.get('sparse'):
+        job += " && " + sparseJob(info, dot)
+    return job
+
+
+def sparseDirs(dot):
+    return sorted({link.get('from').strip('/').split('/')[0] for link in dot.get('links', []) if link.get('from')})
+
+
+def sparseJob(info, dot):
+    if not dot.get('sparse'):
+        return gitCommand(info['user'], '-C', info['loc'], 'sparse-checkout', 'disable')
+    return (
+        f"{gitCommand(info['user'], '-C', info['loc'], 'ls-tree', '-d', '--name-only', 'HEAD', '--', *sparseDirs(dot))} | "
+        f"{gitCommand(info['user'], '-C', info['loc'], 'sparse-checkout', 'set', '--stdin')}"
+    )
+
+
+def sparseStale(current, desired, tree):
+    if current is None or desired is None:
+        return current != desired
+    return current != desired & tree
+
+
+def staleSparse(active, snapshot):
+    stale = []
+    for info, dot in active:
+        if info['loc'] not in snapshot['repos']:
+            continue
+        current = snapshot['sparse'].get(info['loc'])
+        desired = set(sparseDirs(dot)) if dot.get('sparse') else None
+        if sparseStale(current, desired, snapshot['tree'].get(info['loc'], current)):
+            stale.append((info, dot))
+    return stale
+
+
+def sparseUpdates(host, stale):
+    if not stale:
+        return set()
+    jobs = []
+    for info, dot in stale:
+        print(f"Updating sparse checkout of '{info['name']}' for '{info['user']}'.")
+        jobs.append((info['loc'], sparseJob(info, dot)))
+
+    # HACK: Update at fact time so newly referenced sources can be linked in this same run
+    rawOutput = getFact(host, Command, f"( {concurrentScript([jobs])} ) || true", _sudo=True)
+    updated, failed = jobResults(rawOutput)
+    for loc, message in failed.items():
+        print(f"Warning: Could not update the sparse checkout of {loc}: {message}")
+    return updated
+
+
+def pullJob(info, dot):
+    branch = dot.get('branch', 'main')
+    shallow = dot.get('depth') and not dot.get('shared')
+    remote = mirrorPath(dot) if dot.get('shared') else 'origin'
+    fetchArgs = ['--depth', int(dot.get('depth'))] if shallow else []
+    update = ['reset', '-q', '--keep', 'FETCH_HEAD'] if shallow else ['merge', '-q', '--ff-only', 'FETCH_HEAD']
+    safeMirror = ['-c', f"safe.directory={remote}"] if dot.get('shared') else []
+    return " && ".join([
+        gitCommand(info['user'], *safeMirror, '-C', info['loc'], 'fetch', '-q', *fetchArgs, remote, branch),
+        gitCommand(info['user'], '-C', info['loc'], 'checkout', '-q', branch),
+        gitCommand(info['user'], '-C', info['loc'], *update),
+    ])
+
+
+def concurrentScript(phases):
+    lines = ['status=0']
+    report = "printf '%s\\t%s\\n'"
+    for jobs in phases:
+        if not jobs:
+            continue
+        lines.append('pids=""')
+        for loc, job in jobs:
+            lines.append(
+                f"( err=\"$(mktemp)\"; if ( {job} ) >/dev/null 2>\"$err\"; then {report} ok {shlex.quote(loc)}; rm -f \"$err\"; "
+                f"else printf 'failed\\t%s\\t%s\\n' {shlex.quote(loc)} \"$( (grep -E '^(fatal|error):' \"$err\" || cat \"$err\") | tail -n 3 | tr '\\t\\n' '  ')\"; "
+                f"rm -f \"$err\"; exit 1; fi ) & pids=\"$pids $!\""
+            )
+        lines.append('for pid in $pids; do wait "$pid" || status=1; done')
+    lines.append('exit $status')
+    return "\n".join(lines)
+
+
+def jobResults(rawOutput):
+    done, failed = set(), {}
+    for line in (rawOutput or "").splitlines():
+        parts = line.split('\t')
+        if len(parts) == 2 and parts[0] == 'ok':
+            done.add(parts[1])
+        elif len(parts) >= 2 and parts[0] == 'failed':
+            failed[parts[1]] = (parts[2] if len(parts) > 2 else '').strip() or "no error output"
+    return done, failed
+
+
+def cloneRepos(host, clones, fetchedMirrors):
+    if not clones:
+        return set(), {}
+
+    for info, dot in clones:
+        print(f"Cloning {dot.get('url')} to {info['loc']}.")
+    script = concurrentScript([
+        mirrorJobs(clones, fetchedMirrors),
+        [(info['loc'], cloneJob(info, dot)) for info, dot in clones],
+    ])
+    # HACK: Clone at fact time so the fresh checkouts can be linked in this same run
+    rawOutput = getFact(host, Command, f"( {script} ) || true", _sudo=True)
+
+    cloned, failed = jobResults(rawOutput)
+    for loc, message in failed.items():
+        print(f"Error: Could not clone {loc}: {message}")
+    return cloned, failed
+
+
+def pullScript(pulls, fetchedMirrors):
+    if not pulls:
+        return None
+    return concurrentScript([
+        mirrorJobs(pulls, fetchedMirrors),
+        [(info['loc'], pullJob(info, dot)) for info, dot in pulls],
+    ])
+
+
+def remoteCheckMode():
+    return os.environ.get('CHAOS_DOTFILES_REMOTE_CHECK', 'control')
+
+
+def remoteKey(dot):
+    return (dot.get('url'), dot.get('branch', 'main'))
+
+
+def lsRemote(key):
+    url, branch = key
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0', GIT_SSH_COMMAND='ssh -o BatchMode=yes')
+    try:
+        result = subprocess.run(
+            ['git', 'ls-remote', url, f"refs/heads/{branch}"],
+            capture_output=True, text=True, env=env, timeout=LS_REMOTE_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.partition('\t')[0] or None
+
+
+def controlRemoteHeads(keys):
+    missing = [key for key in keys if key not in _remoteHeads]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(len(missing), 8)) as pool:
+            _remoteHeads.update(zip(missing, pool.map(lsRemote, missing)))
+    return {key: _remoteHeads[key] for key in keys if _remoteHeads[key]}
+
+
+def hostRemoteHeads(host, pulls):
+    lines = []
+    for info, dot in pulls:
+        url, branch = remoteKey(dot)
+        command = gitCommand(info['user'], 'ls-remote', url, f"refs/heads/{branch}")
+        lines.append(f"printf 'X\\t%s\\t%s\\n' {shlex.quote(info['loc'])} \"$({command} 2>/dev/null | cut -f1)\" &")
+    lines += ['wait', 'true']
+    rawOutput = getFact(host, Command, "\n".join(lines), _sudo=True)
+
+    heads = {}
+    for line in (rawOutput or "").splitlines():
+        parts = line.split('\t')
+        if len(parts) == 3 and parts[0] == 'X' and parts[2]:
+            heads[parts[1]] = parts[2]
+    return heads
+
+
+def stalePulls(host, pulls, snapshot):
+    mode = remoteCheckMode()
+    if not pulls or mode == 'off':
+        return pulls
+
+    heads = {}
+    if mode == 'control':
+        known = controlRemoteHeads({remoteKey(dot) for info, dot in pulls})
+        heads = {info['loc']: known[remoteKey(dot)] for info, dot in pulls if remoteKey(dot) in known}
+    unknown = [(info, dot) for info, dot in pulls if info['loc'] not in heads]
+    if unknown:
+        heads.update(hostRemoteHeads(host, unknown))
+
+    stale = []
+    for info, dot in pulls:
+        head = heads.get(info['loc'])
+        if head and head == snapshot['commits'].get(info['loc']):
+            print(f"Dotfiles repo '{info['name']}' for '{info['user']}' is at the remote {dot.get('branch', 'main')}, skipping fetch.")
+            continue
+        stale.append((info, dot))
+    return stale
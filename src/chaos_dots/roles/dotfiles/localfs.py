@@ -0,0 +1,276 @@
+from fnmatch import fnmatchcase
+import hashlib
+import os
+import stat
+import subprocess
+
+from pyinfra.connectors.local import LocalConnector
+
+FILE_TYPES = (
+    (stat.S_ISLNK, 'l'),
+    (stat.S_ISDIR, 'd'),
+    (stat.S_ISREG, 'f'),
+    (stat.S_ISFIFO, 'p'),
+    (stat.S_ISSOCK, 's'),
+    (stat.S_ISCHR, 'c'),
+    (stat.S_ISBLK, 'b'),
+)
+
+
+def isLocalHost(host):
+    if os.environ.get('CHAOS_DOTFILES_NO_LOCAL'):
+        return False
+    connector = getattr(host, 'connector_cls', None)
+    return isinstance(connector, type) and issubclass(connector, LocalConnector)
+
+
+def fileType(mode):
+    for check, letter in FILE_TYPES:
+        if check(mode):
+            return letter
+    return 'U'
+
+
+def probeMode(path, follow=True):
+    # Unlike os.path.isdir/isfile, a permission error is raised instead of being
+    # read as a missing path, so callers can fall back to collecting through sudo.
+    try:
+        return (os.stat if follow else os.lstat)(path).st_mode
+    except PermissionError:
+        raise
+    except OSError:
+        return None
+
+
+def isDir(path):
+    mode = probeMode(path)
+    return mode is not None and stat.S_ISDIR(mode)
+
+
+def isRealDir(path):
+    mode = probeMode(path, follow=False)
+    return mode is not None and stat.S_ISDIR(mode)
+
+
+def isFile(path):
+    mode = probeMode(path)
+    return mode is not None and stat.S_ISREG(mode)
+
+
+def raiseError(error):
+    raise error
+
+
+def hasNewline(path, letter):
+    return '\n' in path or letter == 'l' and '\n' in os.readlink(path)
+
+
+def lstatEntry(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    letter = fileType(mode)
+    if hasNewline(path, letter):
+        return None
+    return letter, os.readlink(path) if letter == 'l' else ''
+
+
+def walk(top, maxDepth, prunes=(), depth=1):
+    with os.scandir(top) as entries:
+        for entry in entries:
+            if any(fnmatchcase(entry.name, pattern) for pattern in prunes):
+                continue
+            letter = fileType(entry.stat(follow_symlinks=False).st_mode)
+            if hasNewline(entry.path, letter):
+                continue
+            yield entry.path, letter
+            if depth < maxDepth and letter == 'd':
+                yield from walk(entry.path, maxDepth, prunes, depth + 1)
+
+
+def gitDir(loc):
+    path = f"{loc}/.git"
+    if isFile(path):
+        with open(path) as gitFile:
+            path = os.path.join(loc, gitFile.read().partition('gitdir:')[2].strip())
+    return path
+
+
+def readHead(loc):
+    repoDir = gitDir(loc)
+    try:
+        with open(f"{repoDir}/HEAD") as headFile:
+            head = headFile.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return ''
+    if not head.startswith('ref:'):
+        return head
+    ref = head[4:].strip()
+    try:
+        with open(f"{repoDir}/{ref}") as refFile:
+            return refFile.read().strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with open(f"{repoDir}/packed-refs") as packedFile:
+            for line in packedFile:
+                commit, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return commit
+    except FileNotFoundError:
+        pass
+    return ''
+
+
+def sparsePatterns(loc):
+    repoDir = gitDir(loc)
+    enabled = False
+    for name in ('config', 'config.worktree'):
+        try:
+            with open(f"{repoDir}/{name}") as configFile:
+                for line in configFile:
+                    key, _, value = line.partition('=')
+                    if key.strip().lower() == 'sparsecheckout':
+                        enabled = value.strip().lower() in ('true', 'yes', 'on', '1')
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    if not enabled:
+        return None
+    try:
+        with open(f"{repoDir}/info/sparse-checkout") as patternFile:
+            return patternFile.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def treeDirs(loc):
+    if os.lstat(loc).st_uid != os.geteuid():
+        raise PermissionError(f"{loc} is not owned by the current user")
+    result = subprocess.run(
+        ['git', '-C', loc, 'ls-tree', '-d', '--name-only', 'HEAD'],
+        capture_output=True, text=True,
+    )
+    return result.stdout.splitlines() if result.returncode == 0 else []
+
+
+def openDigest(lines):
+    return hashlib.sha256("".join(f"{line}\n" for line in sorted(set(lines))).encode()).hexdigest()
+
+
+def sourceLines(sourcePath, depth, prunes):
+    if isRealDir(sourcePath):
+        for path, letter in walk(sourcePath, depth, prunes):
+            yield f"O\t{sourcePath}\t{path[len(sourcePath) + 1:]}\t{letter}"
+
+
+def digestLines(loc, sources, targets):
+    for sourcePath, depth, prunes in sources:
+        yield from sourceLines(sourcePath, depth, prunes)
+    for targetPath, depth in targets:
+        if isDir(targetPath):
+            for path, letter in walk(targetPath, depth):
+                if letter == 'l' and os.readlink(path).startswith(f"{loc}/"):
+                    yield targetLine(path, (letter, os.readlink(path)))
+
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as content:
+        for block in iter(lambda: content.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def treeHash(top):
+    files = []
+    for dirPath, dirNames, fileNames in os.walk(top, onerror=raiseError):
+        dirNames[:] = [name for name in dirNames if '\n' not in name]
+        for name in fileNames:
+            path = os.path.join(dirPath, name)
+            mode = probeMode(path, follow=False)
+            if mode is not None and stat.S_ISREG(mode) and not hasNewline(path, fileType(mode)):
+                files.append(os.fsencode('./' + os.path.relpath(path, top)))
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(f"{fileHash(os.path.join(top, os.fsdecode(name)))}  {os.fsdecode(name)}\n".encode())
+    return digest.hexdigest()
+
+
+def readFiles(paths):
+    contents = {}
+    for path in paths:
+        if isFile(path):
+            with open(path, 'rb') as content:
+                contents[path] = content.read()
+    return contents
+
+
+def passwdLines():
+    with open('/etc/passwd') as passwdFile:
+        for line in passwdFile:
+            fields = line.rstrip('\n').split(':')
+            if len(fields) >= 7:
+                yield f"P\t{fields[0]}\t{fields[2]}\t{fields[6]}"
+
+
+def targetLine(path, entry):
+    return f"T\t{path}\t{entry[0]}\t{entry[1]}"
+
+
+def fileLines(path):
+    if isFile(path):
+        yield f"S\t{path}"
+        with open(path) as content:
+            for line in content.read().splitlines():
+                yield f"C\t{line}"
+
+
+def snapshotLines(request):
+    yield from passwdLines()
+    for loc, user, stateFile, closedTargets in request.repos:
+        if isDir(loc):
+            yield f"R\t{loc}"
+            yield f"H\t{loc}\t{readHead(loc)}"
+            for name in os.listdir(loc):
+                if hasNewline(f"{loc}/{name}", fileType(os.lstat(f"{loc}/{name}").st_mode)):
+                    continue
+                yield f"L\t{loc}\t{name}"
+            patterns = sparsePatterns(loc)
+            if patterns is not None:
+                yield f"K\t{loc}\t"
+                for pattern in patterns:
+                    yield f"K\t{loc}\t{pattern}"
+                yield f"Y\t{loc}\t"
+                for name in treeDirs(loc):
+                    yield f"Y\t{loc}\t{name}"
+        yield from fileLines(stateFile)
+        for path in closedTargets:
+            entry = lstatEntry(path)
+            if entry:
+                yield targetLine(path, entry)
+
+    for sourcePath, depth, prunes in request.sources:
+        yield from sourceLines(sourcePath, depth, prunes)
+    for loc, sources, targets in request.digests:
+        yield f"G\t{loc}\t{openDigest(digestLines(loc, sources, targets))}"
+    for targetPath, depth in request.targets:
+        if isDir(targetPath):
+            for path, letter in walk(targetPath, depth):
+                yield targetLine(path, (letter, os.readlink(path) if letter == 'l' else ''))
+    for path in request.files:
+        yield from fileLines(path)
+    for path in request.hashes:
+        if isFile(path):
+            yield f"Z\t{path}\t{fileHash(path)}"
+        elif isRealDir(path):
+            yield f"Z\t{path}\t{treeHash(path)}"
+
+
+def statPaths(paths):
+    found = {}
+    for path in paths:
+        entry = lstatEntry(path)
+        if entry:
+            found[path] = entry
+    return found
@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+import atexit
+import json
+import os
+import time
+
+from pyinfra.api.operation import add_op as pyinfraAddOp
+from pyinfra.api.state import BaseStateCallback
+
+METRICS_VERSION = 1
+
+_runMetrics = None
+_current = {'host': None, 'repo': None}
+_opOwners = {}
+
+
+def metricsPath():
+    return os.environ.get('CHAOS_DOTFILES_METRICS')
+
+
+def newHostMetrics():
+    return {'phases': {}, 'facts': 0, 'factBytes': 0, 'ops': 0, 'repos': {}}
+
+
+def newRepoMetrics():
+    return {'phases': {}, 'ops': 0}
+
+
+def sectionFor(hostName, repo=None):
+    hostMetrics = _runMetrics['hosts'].setdefault(hostName, newHostMetrics())
+    if repo is None:
+        return hostMetrics
+    return hostMetrics['repos'].setdefault(repo, newRepoMetrics())
+
+
+def addTime(section, phase, seconds):
+    section['phases'][phase] = round(section['phases'].get(phase, 0.0) + seconds, 6)
+
+
+class OpTimer(BaseStateCallback):
+    def __init__(self):
+        self.started = {}
+
+    def operation_host_start(self, state, host, op_hash):
+        if (host.name, op_hash) in _opOwners:
+            self.started[(host.name, op_hash)] = time.perf_counter()
+
+    def operation_host_success(self, state, host, op_hash, retry_count=0):
+        start = self.started.pop((host.name, op_hash), None)
+        if start is not None and _runMetrics is not None:
+            elapsed = time.perf_counter() - start
+            addTime(sectionFor(host.name), 'execute', elapsed)
+            repo = _opOwners[(host.name, op_hash)]
+            if repo:
+                addTime(sectionFor(host.name, repo), 'execute', elapsed)
+
+    def operation_host_error(self, state, host, op_hash, retry_count=0, max_retries=0):
+        self.operation_host_success(state, host, op_hash, retry_count)
+
+
+def startMetrics(state):
+    global _runMetrics
+    if _runMetrics is not None or not metricsPath():
+        return _runMetrics
+    _runMetrics = {'version': METRICS_VERSION, 'hosts': {}}
+    if hasattr(state, 'add_callback_handler'):
+        state.add_callback_handler(OpTimer())
+    atexit.register(emitMetrics)
+    return _runMetrics
+
+
+@contextmanager
+def timed(host, phase, repo=None):
+    if _runMetrics is None:
+        yield
+        return
+    previous = dict(_current)
+    _current.update({'host': host.name, 'repo': repo})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(sectionFor(host.name, repo), phase, time.perf_counter() - start)
+        _current.update(previous)
+
+
+def resultBytes(result):
+    if isinstance(result, str):
+        return len(result.encode())
+    if isinstance(result, dict) and 'bytes' in result:
+        return result['bytes']
+    if isinstance(result, dict):
+        return sum(len(path) + len(entry.type) + len(entry.link or '') + 3 for path, entry in result.items())
+    return 0
+
+
+def getFact(host, fact, *args, **kwargs):
+    result = host.get_fact(fact, *args, **kwargs)
+    if _runMetrics is not None:
+        section = sectionFor(host.name)
+        section['facts'] += 1
+        section['factBytes'] += resultBytes(result)
+    return result
+
+
+def add_op(state, op, *args, **kwargs):
+    results = pyinfraAddOp(state, op, *args, **kwargs)
+    host = kwargs.get('host')
+    if _runMetrics is not None and host is not None:
+        repo = _current['repo'] if _current['host'] == host.name else None
+        sectionFor(host.name)['ops'] += 1
+        if repo:
+            sectionFor(host.name, repo)['ops'] += 1
+        for meta in (results or {}).values():
+            _opOwners[(host.name, getattr(meta, '_hash', None))] = repo
+    return results
+
+
+def emitMetrics():
+    if _runMetrics is None:
+        return
+    content = json.dumps(_runMetrics, indent=2)
+    path = metricsPath()
+    if path == '-':
+        print(content)
+        return
+    with open(path, 'w') as metricsFile:
+        metricsFile.write(content + "\n")
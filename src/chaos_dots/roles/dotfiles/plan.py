@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sys
+
+PLAN_VERSION = 1
+PLAN_ACTIONS = ('remove', 'discard', 'backup', 'mkdir', 'link', 'install', 'copy', 'prune')
+
+
+def planOptions():
+    return {
+        'output': os.environ.get('CHAOS_DOTFILES_PLAN_OUT'),
+        'input': os.environ.get('CHAOS_DOTFILES_PLAN_IN'),
+        'planOnly': bool(os.environ.get('CHAOS_DOTFILES_PLAN_ONLY')),
+        'force': bool(os.environ.get('CHAOS_DOTFILES_PLAN_FORCE')),
+    }
+
+
+def choboloHash(choboloPath):
+    with open(choboloPath, 'rb') as choboloFile:
+        return hashlib.sha256(choboloFile.read()).hexdigest()
+
+
+def newRunPlan(choboloPath):
+    return {
+        'version': PLAN_VERSION,
+        'chobolo': os.path.realpath(choboloPath),
+        'choboloHash': choboloHash(choboloPath),
+        'hosts': {},
+    }
+
+
+def readPlan(planPath):
+    with open(planPath) as planFile:
+        runPlan = json.load(planFile)
+    if runPlan.get('version') != PLAN_VERSION:
+        raise ValueError(f"Unsupported dotfiles plan version in {planPath}: {runPlan.get('version')!r}")
+    return runPlan
+
+
+def choboloMismatch(runPlan, choboloPath):
+    if runPlan.get('chobolo') != os.path.realpath(choboloPath):
+        return f"it was made for {runPlan.get('chobolo')}, not {os.path.realpath(choboloPath)}"
+    if runPlan.get('choboloHash') != choboloHash(choboloPath):
+        return f"{runPlan['chobolo']} changed since it was made"
+    return None
+
+
+def commitMismatch(hostName, hostPlan, commits):
+    for loc, commit in hostPlan.get('commits', {}).items():
+        if (commits.get(loc) or '') != commit:
+            return f"{hostName}: {loc} is at {commits.get(loc) or 'no commit'}, the plan was made at {commit or 'no commit'}"
+    return None
+
+
+def writePlan(runPlan, planPath):
+    content = json.dumps(runPlan, indent=2)
+    if planPath == '-':
+        print(content)
+        return
+    with open(planPath, 'w') as planFile:
+        planFile.write(content + "\n")
+    print(f"Dotfiles plan written to {planPath}.")
+
+
+def actionCounts(repoPlan):
+    counts = dict.fromkeys(PLAN_ACTIONS, 0)
+    for entry in repoPlan.get('manifest', []):
+        counts[entry[0]] = counts.get(entry[0], 0) + 1
+    return counts
+
+
+def pendingChanges(runPlan):
+    total = 0
+    for hostPlan in runPlan['hosts'].values():
+        total += 1 if hostPlan.get('pull') else 0
+        total += len(hostPlan.get('bundles', []))
+        for repoPlan in hostPlan['repos']:
+            if repoPlan['status'] == 'planned':
+                total += sum(actionCounts(repoPlan).values()) or 1
+            elif repoPlan['status'] in ('cloning', 'resparse'):
+                total += 1
+    return total
+
+
+def summaryTable(runPlan):
+    header = ('HOST', 'USER', 'REPO', 'STATUS') + tuple(action.upper() for action in PLAN_ACTIONS)
+    rows = []
+    for hostName, hostPlan in runPlan['hosts'].items():
+        for repoPlan in hostPlan['repos']:
+            counts = actionCounts(repoPlan)
+            rows.append((hostName, repoPlan['user'], repoPlan['name'], repoPlan['status']) +
+                        tuple(str(counts[action]) for action in PLAN_ACTIONS))
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in [header] + rows)
+
+
+def printPlan(runPlan, stream=None):
+    stream = stream or sys.stdout
+    print("\nDotfiles plan:", file=stream)
+    print(summaryTable(runPlan), file=stream)
+    for hostName, hostPlan in runPlan['hosts'].items():
+        if hostPlan.get('pull'):
+            print(f"{hostName}: {len(hostPlan['pull'])} repo(s) will be updated.", file=stream)
+        for bundle in hostPlan.get('bundles', []):
+            print(f"{hostName}: {bundle['user']}/{bundle['name']} will be updated from {os.path.basename(bundle['bundle'])}", file=stream)
+        for repoPlan in hostPlan['repos']:
+            if repoPlan['status'] == 'failed':
+                print(f"{hostName}: {repoPlan['user']}/{repoPlan['name']} could not be cloned: {repoPlan['error']}", file=stream)
+            elif repoPlan['status'] == 'cloning':
+                print(f"{hostName}: {repoPlan['user']}/{repoPlan['name']} will be cloned, its links are planned on the next run.", file=stream)
+            elif repoPlan['status'] == 'resparse':
+                print(f"{hostName}: {repoPlan['user']}/{repoPlan['name']} will update its sparse checkout, its links are planned on the next run.", file=stream)
+            for source in repoPlan.get('missing', []):
+                print(f"Warning: {hostName}: Source path '{source}' not in repo '{repoPlan['name']}', skipping.", file=stream)
+            for entry in repoPlan.get('manifest', []):
+                if entry[0] == 'remove':
+                    print(f"{hostName}: removing {entry[1]}", file=stream)
+                elif entry[0] == 'discard':
+                    print(f"{hostName}: removing {entry[1]} (backed up if edited)", file=stream)
+
+
+def confirmPlan(runPlan, skip):
+    if not pendingChanges(runPlan):
+        return True
+    confirm = "y" if skip else input("\nApply this plan (Y/n)? ")
+    return confirm.lower() in ["y", "yes", "", "s", "sim"]
+
+
+def emitPlan(runPlan, options):
+    printPlan(runPlan, sys.stderr if options['output'] == '-' else sys.stdout)
+    if options['output']:
+        writePlan(runPlan, options['output'])
+    sys.stdout.flush()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+
+from .capture import readCapture
+from .chobolo import choboloVars, loadChobolo
+from .dotfiles_new import planHost
+from .plan import newRunPlan, printPlan, writePlan
+from .snapshot import DotfilesSnapshot, FilesystemState, parseSnapshot
+from .templates import FileContents
+
+
+class ReplayHost:
+    connector_cls = None
+
+    def __init__(self, path):
+        header, self.lines, self.contents = readCapture(path)
+        self.name = header.get('host') or os.path.basename(path).split('.snapshot')[0]
+        self.data = header.get('data') or {}
+        self.fs = parseSnapshot(self.lines)['fs']
+
+    def get_fact(self, fact, *args, **kwargs):
+        if fact is DotfilesSnapshot:
+            return parseSnapshot(self.lines)
+        if fact is FilesystemState:
+            return {path: self.fs[path] for path in args[0] if path in self.fs}
+        if fact is FileContents:
+            return {path: self.contents[path] for path in args[0] if path in self.contents}
+        return None
+
+
+def replayPlan(choboloPath, hosts):
+    dotfiles = loadChobolo(choboloPath)
+    chobolo = choboloVars(choboloPath)
+    runPlan = newRunPlan(choboloPath)
+    for host in hosts:
+        runPlan['hosts'][host.name] = planHost(None, host, dotfiles, chobolo=chobolo)
+    return runPlan
+
+
+def planEntries(runPlan):
+    entries = {}
+    for hostName, hostPlan in runPlan['hosts'].items():
+        for repoPlan in hostPlan['repos']:
+            key = (hostName, repoPlan['user'], repoPlan['name'])
+            entries[key] = (repoPlan['status'], {tuple(entry) for entry in repoPlan.get('manifest', [])})
+    return entries
+
+
+def diffPlans(base, changed, stream=None):
+    stream = stream or sys.stdout
+    before, after = planEntries(base), planEntries(changed)
+    differences = 0
+    for key in sorted(set(before) | set(after)):
+        oldStatus, oldEntries = before.get(key, ('absent', set()))
+        newStatus, newEntries = after.get(key, ('absent', set()))
+        lines = [f"- {' '.join(entry)}" for entry in sorted(oldEntries - newEntries)]
+        lines += [f"+ {' '.join(entry)}" for entry in sorted(newEntries - oldEntries)]
+        if oldStatus == newStatus and not lines:
+            continue
+        differences += 1
+        status = newStatus if oldStatus == newStatus else f"{oldStatus} -> {newStatus}"
+        print(f"{key[0]}: {key[1]}/{key[2]} ({status})", file=stream)
+        for line in lines:
+            print(f"  {line}", file=stream)
+    if not differences:
+        print("No differences between the plans.", file=stream)
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='chaos-dots-replay', description="Plan dotfiles from captured host facts.")
+    parser.add_argument('chobolo', help="path to the chobolo file to plan")
+    parser.add_argument('snapshots', nargs='+', help="files captured with CHAOS_DOTFILES_CAPTURE")
+    parser.add_argument('--base', help="chobolo to compare against; prints only the differences")
+    parser.add_argument('--plan-out', help="write the replayed plan as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    os.environ['CHAOS_DOTFILES_REMOTE_CHECK'] = 'off'
+    os.environ['CHAOS_DOTFILES_OFFLINE'] = '1'
+    try:
+        hosts = [ReplayHost(path) for path in args.snapshots]
+    except (OSError, ValueError) as error:
+        print(f"Could not read snapshot: {error}", file=sys.stderr)
+        return 1
+
+    runPlan = replayPlan(args.chobolo, hosts)
+    if args.base:
+        diffPlans(replayPlan(args.base, hosts), runPlan)
+    else:
+        printPlan(runPlan)
+    if args.plan_out:
+        writePlan(runPlan, args.plan_out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
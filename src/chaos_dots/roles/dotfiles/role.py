@@ -0,0 +1,3 @@
+def runDotfiles(state, host, choboloPath, skip):
+    from .dotfiles_new import runDotfiles as run
+    return run(state, host, choboloPath, skip)
@@ -0,0 +1,363 @@
+from collections import namedtuple
+from fnmatch import fnmatch
+from io import StringIO
+import os
+import re
+import shlex
+
+from pyinfra.api import FactBase
+
+from . import localfs
+from .capture import captureDir
+from .localfs import isLocalHost
+from .metrics import getFact
+
+USER_SHELL_RE = re.compile(r'(bash|zsh|fish|sh)$')
+FIND_FORMAT = "'T\\t%p\\t%y\\t%l\\n'"
+MAX_COMMAND_BYTES = 64 * 1024
+# Records are newline-delimited, so names and link targets containing a newline
+# are left out of every listing instead of splitting into forged records.
+SKIP_NEWLINES = "\\( -name \"$nl\" -o -lname \"$nl\" \\) -prune -o "
+SNAPSHOT_FUNCTIONS = r"""nl='*
+*'
+run_as() {
+    if [ -n "$1" ]; then user="$1"; shift; sudo -u "$user" -H "$@"; else shift; "$@"; fi
+}
+repo() {
+    [ -d "$1" ] || return 0
+    printf 'R\t%s\n' "$1"
+    printf 'H\t%s\t%s\n' "$1" "$(run_as "$2" git -C "$1" rev-parse HEAD 2>/dev/null)"
+    find "$1" -mindepth 1 -maxdepth 1 \( -name "$nl" -o -lname "$nl" \) -prune -o -printf 'L\t%H\t%f\n' 2>/dev/null
+    [ "$(run_as "$2" git -C "$1" config --bool core.sparseCheckout 2>/dev/null)" = true ] || return 0
+    printf 'K\t%s\t\n' "$1"
+    awk -v loc="$1" '{print "K\t" loc "\t" $0}' "$1/.git/info/sparse-checkout" 2>/dev/null
+    printf 'Y\t%s\t\n' "$1"
+    run_as "$2" git -C "$1" ls-tree -d --name-only HEAD 2>/dev/null | awk -v loc="$1" '{print "Y\t" loc "\t" $0}'
+}
+show_file() {
+    [ -f "$1" ] || return 0
+    printf 'S\t%s\n' "$1"
+    awk '{print "C\t" $0}' "$1"
+}
+hashes() {
+    for f in "$@"; do
+        if [ -f "$f" ]; then
+            printf 'Z\t%s\t%s\n' "$f" "$(sha256sum < "$f" | cut -c1-64)"
+        elif [ -d "$f" ] && [ ! -L "$f" ]; then
+            printf 'Z\t%s\t%s\n' "$f" "$(cd "$f" && find . \( -name "$nl" -o -lname "$nl" \) -prune -o -type f -print0 | LC_ALL=C sort -z | xargs -0 -r sha256sum | sha256sum | cut -c1-64)"
+        fi
+    done
+}"""
+STAT_COMMAND = (
+    "printf '%s\\0' {paths} | xargs -0 -r sh -c "
+    "'find \"$@\" -maxdepth 0 -printf \"%p\\0%y\\0%l\\0\" 2>/dev/null' sh || true"
+)
+
+
+def describeDot(dot):
+    user = dot.get('user')
+    dotName = dot.get('url').split('/')[-1].replace('.git', '')
+    userHome = f"/home/{user}"
+    return {
+        'user': user,
+        'name': dotName,
+        'home': userHome,
+        'loc': f"{userHome}/.dotfiles/chaos/{dotName}",
+        'stateFile': f"{userHome}/.local/state/chaos/dotfiles_{dotName}",
+    }
+
+
+def linkTargets(info, link):
+    source = link.get('from')
+    destRel = link.get('to') or source
+    if link.get('open'):
+        return f"{info['loc']}/{source}", os.path.normpath(f"{info['home']}/{destRel}")
+    linkPath = source if destRel == '.' else destRel
+    return f"{info['loc']}/{source}", f"{info['home']}/{linkPath}"
+
+
+class FsEntry(namedtuple('FsEntry', ['type', 'link'])):
+    __slots__ = ()
+
+    @property
+    def is_link(self):
+        return self.type == 'l'
+
+    @property
+    def is_dir(self):
+        return self.type == 'd'
+
+
+def fsEntry(fileType, linkTarget):
+    return FsEntry(fileType, linkTarget if fileType == 'l' else None)
+
+
+def statChunks(paths, limit=MAX_COMMAND_BYTES):
+    chunk, size = [], 0
+    for path in paths:
+        quoted = len(shlex.quote(path)) + 1
+        if chunk and size + quoted > limit:
+            yield tuple(chunk)
+            chunk, size = [], 0
+        chunk.append(path)
+        size += quoted
+    if chunk:
+        yield tuple(chunk)
+
+
+def localStat(paths):
+    return {path: fsEntry(*entry) for path, entry in localfs.statPaths(paths).items()}
+
+
+class FilesystemState(FactBase):
+    def command(self, paths):
+        return STAT_COMMAND.format(paths=" ".join(shlex.quote(path) for path in paths))
+
+    def process(self, output):
+        fields = "\n".join(output).split('\0')
+        return {
+            fields[i]: fsEntry(fields[i + 1], fields[i + 2])
+            for i in range(0, len(fields) - 2, 3)
+        }
+
+
+def openDepth(link):
+    return max(int(link.get('depth') or 1), 1)
+
+
+def openIgnores(link):
+    return list(link.get('ignore') or [])
+
+
+def isIgnored(relPath, ignore):
+    baseName = relPath.rsplit('/', 1)[-1]
+    return any(fnmatch(relPath, pattern) or fnmatch(baseName, pattern) for pattern in ignore)
+
+
+def openItems(entries, depth, ignore):
+    items, dirs, skipped = [], [], set()
+    for relPath, fileType in sorted(entries):
+        parts = relPath.split('/')
+        if len(parts) > depth:
+            continue
+        if any('/'.join(parts[:i]) in skipped for i in range(1, len(parts))):
+            continue
+        if isIgnored(relPath, ignore):
+            skipped.add(relPath)
+            continue
+        if fileType == 'd' and len(parts) < depth:
+            dirs.append(relPath)
+        else:
+            items.append(relPath)
+    return items, dirs
+
+
+SnapshotRequest = namedtuple('SnapshotRequest', ['repos', 'sources', 'targets', 'files', 'hashes', 'digests'])
+
+
+def openListing(info, links):
+    sources, listed = {}, {}
+    for link in links:
+        if not link.get('open'):
+            continue
+        sourcePath, targetPath = linkTargets(info, link)
+        prunes = {pattern for pattern in openIgnores(link) if '/' not in pattern}
+        if sourcePath in sources:
+            depth, known = sources[sourcePath]
+            sources[sourcePath] = (max(depth, openDepth(link)), known & prunes)
+        else:
+            sources[sourcePath] = (openDepth(link), prunes)
+        listed[targetPath] = max(listed.get(targetPath, 0), openDepth(link))
+    return (
+        tuple((sourcePath, depth, tuple(sorted(prunes))) for sourcePath, (depth, prunes) in sources.items()),
+        tuple(listed.items()),
+    )
+
+
+def snapshotRequest(dots, files=(), full=True):
+    repos, statted, sources, listed, hashes, digests = [], set(), [], {}, [], []
+    capturing = bool(captureDir())
+
+    for info, links in dots:
+        closedTargets = []
+        for link in links:
+            sourcePath, targetPath = linkTargets(info, link)
+            if link.get('template') or link.get('mode') == 'copy' or capturing and not link.get('open'):
+                hashes.extend((sourcePath, targetPath))
+            if not link.get('open') and targetPath not in statted:
+                statted.add(targetPath)
+                closedTargets.append(targetPath)
+        repos.append((info['loc'], info['user'], info['stateFile'], tuple(closedTargets)))
+        repoSources, repoTargets = openListing(info, links)
+        if not full:
+            if repoSources:
+                digests.append((info['loc'], repoSources, repoTargets))
+            continue
+        sources.extend(repoSources)
+        for targetPath, depth in repoTargets:
+            listed[targetPath] = max(listed.get(targetPath, 0), depth)
+
+    return SnapshotRequest(
+        tuple(repos),
+        tuple(sources),
+        tuple(listed.items()),
+        tuple(files),
+        tuple(dict.fromkeys(hashes)),
+        tuple(digests),
+    )
+
+
+def sourceScript(sourcePath, depth, prunes):
+    pruneExpr = "".join(f"-name {shlex.quote(pattern)} -prune -o " for pattern in prunes)
+    return f"find {shlex.quote(sourcePath)} -mindepth 1 -maxdepth {depth} {SKIP_NEWLINES}{pruneExpr}-printf 'O\\t%H\\t%P\\t%y\\n'"
+
+
+def snapshotCommands(request):
+    q = shlex.quote
+    lines = ["awk -F: '{printf \"P\\t%s\\t%s\\t%s\\n\", $1, $3, $7}' /etc/passwd"]
+
+    for loc, user, stateFile, closedTargets in request.repos:
+        lines.append(f"repo {q(loc)} {q(user)}")
+        lines.append(f"show_file {q(stateFile)}")
+        for chunk in statChunks(closedTargets):
+            paths = " ".join(q(path) for path in chunk)
+            lines.append(f"find {paths} -maxdepth 0 {SKIP_NEWLINES}-printf {FIND_FORMAT} 2>/dev/null")
+
+    for sourcePath, depth, prunes in request.sources:
+        lines.append(f"{sourceScript(sourcePath, depth, prunes)} 2>/dev/null")
+    for loc, sources, targets in request.digests:
+        listing = [sourceScript(sourcePath, depth, prunes) for sourcePath, depth, prunes in sources] + [
+            f"find -H {q(targetPath)} -mindepth 1 -maxdepth {depth} {SKIP_NEWLINES}-type l -lname {q(loc + '/*')} -printf 'T\\t%p\\tl\\t%l\\n'"
+            for targetPath, depth in targets
+        ]
+        lines.append(
+            f"printf 'G\\t%s\\t%s\\n' {q(loc)} "
+            f"\"$({{ {'; '.join(listing)}; }} 2>/dev/null | LC_ALL=C sort -u | sha256sum | cut -c1-64)\""
+        )
+    for targetPath, depth in request.targets:
+        lines.append(f"find -H {q(targetPath)} -mindepth 1 -maxdepth {depth} {SKIP_NEWLINES}-printf {FIND_FORMAT} 2>/dev/null")
+
+    lines.extend(f"show_file {q(path)}" for path in request.files)
+    for chunk in statChunks(request.hashes):
+        lines.append(f"hashes {' '.join(q(path) for path in chunk)}")
+    return lines
+
+
+def buildSnapshotScripts(request, limit=MAX_COMMAND_BYTES):
+    limit -= len(SNAPSHOT_FUNCTIONS) + len("\ntrue")
+    scripts, lines, size = [], [], 0
+    for line in snapshotCommands(request):
+        if lines and size + len(line) + 1 > limit:
+            scripts.append(lines)
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line) + 1
+    scripts.append(lines)
+    return ["\n".join([SNAPSHOT_FUNCTIONS] + lines + ["true"]) for lines in scripts]
+
+
+def buildSnapshotScript(request, index=0):
+    return buildSnapshotScripts(request)[index]
+
+
+def parseSnapshot(output):
+    snapshot = {
+        'users': set(), 'sysUsers': set(), 'repos': {}, 'commits': {}, 'states': {}, 'hashes': {},
+        'sparse': {}, 'tree': {}, 'digests': {}, 'open': {}, 'fs': {}, 'listed': {}, 'statted': set(), 'bytes': 0,
+    }
+    if isinstance(output, str):
+        output = StringIO(output)
+
+    stateLines = None
+    for line in output or ():
+        snapshot['bytes'] += len(line) + 1
+        line = line.rstrip('\n')
+        kind, _, rest = line.partition('\t')
+        if kind == 'C' and stateLines is not None:
+            stateLines.append(rest)
+            continue
+        parts = rest.split('\t')
+        if kind == 'P' and len(parts) >= 3:
+            name, uid, shell = parts[0], parts[1], parts[2]
+            if not uid.isdigit():
+                continue
+            if int(uid) < 1000:
+                snapshot['sysUsers'].add(name)
+            elif USER_SHELL_RE.search(shell) and name != 'nobody':
+                snapshot['users'].add(name)
+        elif kind == 'R':
+            snapshot['repos'].setdefault(rest, set())
+        elif kind == 'H' and len(parts) >= 2 and parts[1]:
+            snapshot['commits'][parts[0]] = parts[1]
+        elif kind == 'G' and len(parts) >= 2:
+            snapshot['digests'][parts[0]] = parts[1]
+        elif kind == 'Z' and len(parts) >= 2:
+            snapshot['hashes'][parts[0]] = parts[1]
+        elif kind == 'K' and len(parts) >= 2:
+            sparseSet = snapshot['sparse'].setdefault(parts[0], set())
+            if parts[1].startswith('/') and parts[1].endswith('/') and '/' not in parts[1][1:-1] and '*' not in parts[1]:
+                sparseSet.add(parts[1][1:-1])
+        elif kind == 'Y' and len(parts) >= 2:
+            treeSet = snapshot['tree'].setdefault(parts[0], set())
+            if parts[1]:
+                treeSet.add(parts[1])
+        elif kind == 'L' and len(parts) >= 2:
+            snapshot['repos'].setdefault(parts[0], set()).add(parts[1])
+        elif kind == 'S':
+            stateLines = snapshot['states'][rest] = []
+        elif kind == 'O' and len(parts) >= 3:
+            snapshot['open'].setdefault(parts[0], []).append((parts[1], parts[2]))
+        elif kind == 'T' and len(parts) >= 2:
+            linkTarget = parts[2] if len(parts) > 2 else ""
+            snapshot['fs'][parts[0]] = fsEntry(parts[1], linkTarget)
+
+    snapshot['states'] = {path: "\n".join(content) for path, content in snapshot['states'].items()}
+    return snapshot
+
+
+class DotfilesSnapshot(FactBase):
+    def command(self, request, index=0):
+        return buildSnapshotScript(request, index)
+
+    def process(self, output):
+        return parseSnapshot(output)
+
+
+def collectSnapshot(host, dots, files=(), full=True):
+    request = snapshotRequest(dots, files, full)
+    snapshot = None
+    if isLocalHost(host):
+        try:
+            snapshot = parseSnapshot(localfs.snapshotLines(request))
+        except PermissionError:
+            print("Info: Local filesystem not readable directly, collecting dotfile facts through sudo.")
+    if snapshot is None:
+        snapshot = getFact(host, DotfilesSnapshot, request, _sudo=True) or parseSnapshot(())
+        for index in range(1, len(buildSnapshotScripts(request))):
+            mergeSnapshot(snapshot, getFact(host, DotfilesSnapshot, request, index, _sudo=True) or parseSnapshot(()))
+    snapshot['listed'] = dict(request.targets)
+    snapshot['statted'] = {path for repo in request.repos for path in repo[3]}
+    return snapshot
+
+
+def mergeSnapshot(snapshot, other):
+    for key in ('users', 'sysUsers', 'statted'):
+        snapshot[key] |= other[key]
+    for key in ('repos', 'commits', 'states', 'hashes', 'sparse', 'tree', 'digests', 'open', 'fs'):
+        snapshot[key].update(other[key])
+    for path, depth in other['listed'].items():
+        snapshot['listed'][path] = max(snapshot['listed'].get(path, 0), depth)
+    return snapshot
+
+
+def isStatted(snapshot, path):
+    if path in snapshot['statted']:
+        return True
+    parent, level = path, 0
+    while True:
+        parent, child = os.path.dirname(parent), parent
+        level += 1
+        if parent == child:
+            return False
+        if snapshot['listed'].get(parent, 0) >= level:
+            return True
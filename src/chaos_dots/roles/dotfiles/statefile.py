@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+
+from .localfs import openDigest
+from .snapshot import isStatted, openListing
+
+STATE_VERSION = 2
+
+
+def openBase(home, item):
+    return os.path.normpath(f"{home}/{item.get('path')}")
+
+
+def parseState(content, home):
+    if not content or not content.strip():
+        return {"applied": []}
+    if not content.lstrip().startswith('{'):
+        import yaml
+        return yaml.safe_load(content) or {"applied": []}
+
+    lines = iter(content.splitlines())
+    header = json.loads(next(lines))
+    applied = []
+    for line in lines:
+        if not line:
+            continue
+        item = json.loads(line)
+        files = item.pop('files', [])
+        if item.get('open'):
+            prefix = f"{openBase(home, item)}/"
+            item['managed_files'] = [rel if rel.startswith('/') else prefix + rel for rel in files]
+        else:
+            item['managed_files'] = []
+        applied.append(item)
+    header.pop('version', None)
+    header['applied'] = applied
+    return header
+
+
+def readPrevState(snapshot, info):
+    prevStates = snapshot.setdefault('prevStates', {})
+    if info['stateFile'] not in prevStates:
+        prevStates[info['stateFile']] = parseState(snapshot['states'].get(info['stateFile']), info['home'])
+    return prevStates[info['stateFile']]
+
+
+def dumpState(home, applied, commit=None, configHash=None, fingerprint=None, openFingerprint=None):
+    header = {'version': STATE_VERSION}
+    if commit:
+        header.update({
+            'commit': commit, 'config_hash': configHash, 'fingerprint': fingerprint, 'open_fingerprint': openFingerprint,
+        })
+    lines = [json.dumps(header, separators=(',', ':'))]
+    for item in applied:
+        entry = {key: value for key, value in item.items() if key != 'managed_files'}
+        if item.get('open'):
+            prefix = f"{openBase(home, item)}/"
+            entry['files'] = [
+                path[len(prefix):] if path.startswith(prefix) else path
+                for path in item.get('managed_files', [])
+            ]
+        lines.append(json.dumps(entry, separators=(',', ':')))
+    return "\n".join(lines) + "\n"
+
+
+def configHash(links):
+    payload = json.dumps([dict(link) for link in links], sort_keys=True, default=list)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def linkFingerprint(pairs):
+    digest = hashlib.sha256()
+    for targetPath, linkTarget in sorted(pairs):
+        digest.update(f"{targetPath}\0{linkTarget or ''}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def isListed(path, targets):
+    return any(
+        path.startswith(f"{targetPath}/") and path[len(targetPath) + 1:].count('/') < depth
+        for targetPath, depth in targets
+    )
+
+
+def openFingerprint(info, links, snapshot, manifest=()):
+    sources, targets = openListing(info, links)
+    if not sources:
+        return None
+    prefix = f"{info['loc']}/"
+    linked = {
+        path: entry.link for path, entry in snapshot['fs'].items()
+        if entry.is_link and entry.link.startswith(prefix) and isListed(path, targets)
+    }
+    for entry in manifest:
+        if entry[0] == 'link':
+            if entry[1].startswith(prefix) and isListed(entry[2], targets):
+                linked[entry[2]] = entry[1]
+        elif entry[0] in ('remove', 'discard', 'backup', 'install', 'copy'):
+            path = entry[2] if entry[0] in ('install', 'copy') else entry[1]
+            for other in [other for other in linked if other == path or other.startswith(f"{path}/")]:
+                del linked[other]
+    lines = [
+        f"O\t{sourcePath}\t{relPath}\t{fileType}"
+        for sourcePath, depth, prunes in sources for relPath, fileType in snapshot['open'].get(sourcePath, [])
+    ]
+    lines.extend(f"T\t{path}\tl\t{link}" for path, link in linked.items())
+    return openDigest(lines)
+
+
+def managedTargets(info, applied):
+    for item in applied:
+        if item.get('open'):
+            yield from item.get('managed_files', [])
+        elif item.get('path'):
+            yield f"{info['home']}/{item.get('path')}"
+
+
+def isUnchanged(info, links, snapshot, inputs=None):
+    commit = snapshot['commits'].get(info['loc'])
+    prevState = readPrevState(snapshot, info)
+    if not commit or prevState.get('commit') != commit:
+        return False
+    if prevState.get('config_hash') != configHash(links):
+        return False
+    if prevState.get('open_fingerprint') != snapshot['digests'].get(info['loc']):
+        return False
+
+    for item in prevState.get('applied', []):
+        if not item.get('hash'):
+            continue
+        targetPath = f"{info['home']}/{item.get('path')}"
+        if snapshot['hashes'].get(targetPath) != item.get('hash'):
+            return False
+        if item.get('template') and (inputs or {}).get(targetPath) != item.get('input'):
+            return False
+        if item.get('mode') == 'copy' and snapshot['hashes'].get(f"{info['loc']}/{item.get('source')}") != item.get('hash'):
+            return False
+
+    pairs = []
+    for targetPath in managedTargets(info, [item for item in prevState.get('applied', []) if not item.get('open')]):
+        if not isStatted(snapshot, targetPath):
+            return False
+        targetState = snapshot['fs'].get(targetPath)
+        pairs.append((targetPath, targetState.link if targetState else None))
+    return prevState.get('fingerprint') == linkFingerprint(pairs)
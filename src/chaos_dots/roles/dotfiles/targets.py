@@ -0,0 +1,68 @@
+from .statefile import managedTargets, readPrevState
+
+
+def planClaims(plan):
+    return (
+        [(targetPath, sourceItem) for sourceItem, targetPath in plan['links']] + list(plan.get('written', [])) +
+        [(targetPath, None) for targetPath in plan.get('kept', [])]
+    )
+
+
+def keptClaims(info, snapshot):
+    return [(targetPath, None) for targetPath in managedTargets(info, readPrevState(snapshot, info).get('applied', []))]
+
+
+def keepPrevious(info, plan, link, snapshot):
+    source = link.get('from')
+    destRel = link.get('to') or source
+    path = destRel if link.get('open') else (source if destRel == '.' else destRel)
+    for item in readPrevState(snapshot, info).get('applied', []):
+        if item.get('source') == source and item.get('path') == path and bool(item.get('open')) == bool(link.get('open')):
+            plan['applied'].append(item)
+            plan['kept'].extend(managedTargets(info, [item]))
+    return plan
+
+
+def buildTargetIndex(claimsByRepo):
+    index, conflicts = {}, []
+    for info, claims in claimsByRepo:
+        userIndex = index.setdefault(info['user'], {})
+        for targetPath, sourceItem in claims:
+            owner = userIndex.get(targetPath)
+            if owner is None:
+                userIndex[targetPath] = (info['name'], sourceItem)
+            elif owner[0] != info['name'] or owner[1] != sourceItem:
+                conflicts.append((info, targetPath, owner[0]))
+    return index, conflicts
+
+
+def dropTargets(info, plan, targets):
+    if not targets:
+        return plan
+    plan['links'] = [(sourceItem, targetPath) for sourceItem, targetPath in plan['links'] if targetPath not in targets]
+    plan['kept'] = [targetPath for targetPath in plan.get('kept', []) if targetPath not in targets]
+    plan['written'] = [(targetPath, sourcePath) for targetPath, sourcePath in plan.get('written', []) if targetPath not in targets]
+    plan['writes'] = [write for write in plan.get('writes', []) if write[2] not in targets]
+    plan['uploads'] = {write[1]: plan['uploads'][write[1]] for write in plan['writes'] if write[1] in plan['uploads']}
+    applied = []
+    for item in plan['applied']:
+        if item.get('open'):
+            item['managed_files'] = [path for path in item['managed_files'] if path not in targets]
+        elif f"{info['home']}/{item.get('path')}" in targets:
+            continue
+        applied.append(item)
+    plan['applied'] = applied
+    return plan
+
+
+def planRemovals(repos, index, snapshot):
+    removals, assigned = {}, set()
+    for info in repos:
+        userIndex = index.get(info['user'], {})
+        pathsToRemove = []
+        for targetPath in managedTargets(info, readPrevState(snapshot, info).get('applied', [])):
+            if targetPath not in userIndex and targetPath not in assigned:
+                assigned.add(targetPath)
+                pathsToRemove.append(targetPath)
+        removals[info['loc']] = pathsToRemove
+    return removals
@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import json
+import os
+import shlex
+
+from pyinfra.api import FactBase
+
+from . import localfs
+from .localfs import isLocalHost
+from .metrics import getFact
+
+TEMPLATE_CACHE = os.path.expanduser("~/.cache/chaos/dotfiles/templates")
+
+_sources = {}
+_rendered = {}
+
+
+class FileContents(FactBase):
+    def command(self, paths):
+        quoted = " ".join(shlex.quote(path) for path in paths)
+        return (
+            f"for f in {quoted}; do [ -f \"$f\" ] && "
+            f"printf 'B\\t%s\\t%s\\n' \"$f\" \"$(base64 -w0 < \"$f\")\"; done; true"
+        )
+
+    def process(self, output):
+        contents = {}
+        for line in output:
+            parts = line.split('\t')
+            if len(parts) == 3 and parts[0] == 'B':
+                contents[parts[1]] = base64.b64decode(parts[2])
+        return contents
+
+
+def hostVars(host):
+    data = getattr(host, 'data', None)
+    if hasattr(data, 'dict'):
+        return data.dict()
+    return dict(data or {})
+
+
+def dotfileEntry(chobolo, info):
+    from .snapshot import describeDot
+    for dot in (chobolo or {}).get('dotfiles') or []:
+        if isinstance(dot, dict) and dot.get('user') == info['user'] and dot.get('url') and describeDot(dot)['loc'] == info['loc']:
+            return dot
+    return {}
+
+
+def templateContext(host, chobolo, info):
+    return {
+        **hostVars(host), 'host': host, 'dotfile': dotfileEntry(chobolo, info),
+        'user': info['user'], 'home': info['home'],
+    }
+
+
+def contextHash(host, chobolo, info):
+    payload = json.dumps(
+        {'host': host.name, 'data': hostVars(host), 'dotfile': dotfileEntry(chobolo, info), 'user': info['user'], 'home': info['home']},
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def inputKey(sourceHash, varsHash):
+    return hashlib.sha256(f"{sourceHash}:{varsHash}".encode()).hexdigest()[:32]
+
+
+def templateInputs(info, links, snapshot, varsHash):
+    inputs = {}
+    for sourcePath, targetPath in templateTargets(info, links):
+        sourceHash = snapshot['hashes'].get(sourcePath)
+        if sourceHash:
+            inputs[targetPath] = inputKey(sourceHash, varsHash)
+    return inputs
+
+
+def templateTargets(info, links):
+    from .snapshot import linkTargets
+    return [linkTargets(info, link) for link in links if link.get('template')]
+
+
+def cacheDir(host, info):
+    repoHash = hashlib.sha256(f"{host.name}:{info['loc']}".encode()).hexdigest()[:16]
+    return f"{TEMPLATE_CACHE}/{repoHash}"
+
+
+def cachedRender(directory, key):
+    if key not in _rendered:
+        try:
+            with open(f"{directory}/{key}") as cached:
+                _rendered[key] = cached.read()
+        except OSError:
+            return None
+    return _rendered[key]
+
+
+def storeRender(directory, key, content):
+    _rendered[key] = content
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{directory}/.{key}.tmp", 'w') as cached:
+            cached.write(content)
+        os.replace(f"{directory}/.{key}.tmp", f"{directory}/{key}")
+    except OSError:
+        pass
+
+
+def pruneCache(directory, keys):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if name not in keys:
+            try:
+                os.remove(f"{directory}/{name}")
+            except OSError:
+                pass
+
+
+def fetchSources(host, paths):
+    if not paths:
+        return {}
+    if isLocalHost(host):
+        try:
+            return localfs.readFiles(paths)
+        except PermissionError:
+            pass
+    return getFact(host, FileContents, tuple(paths), _sudo=True) or {}
+
+
+def render(source, context):
+    from jinja2 import Environment, StrictUndefined
+    environment = Environment(undefined=StrictUndefined, keep_trailing_newline=True)
+    return environment.from_string(source).render(context)
+
+
+def renderTemplates(host, chobolo, repos, snapshot):
+    from .targets import keepPrevious
+    pending = []
+    current = {}
+    for info, plan in repos:
+        varsHash = contextHash(host, chobolo, info)
+        if plan['templates']:
+            current[cacheDir(host, info)] = set()
+        for link, sourcePath, targetPath in plan['templates']:
+            sourceHash = snapshot['hashes'].get(sourcePath)
+            if not sourceHash:
+                plan['missing'].append(link.get('from'))
+                keepPrevious(info, plan, link, snapshot)
+                continue
+            pending.append((info, plan, link, sourcePath, targetPath, sourceHash, inputKey(sourceHash, varsHash)))
+            current[cacheDir(host, info)].add(pending[-1][-1])
+
+    needed = sorted({
+        sourcePath for info, _, _, sourcePath, _, sourceHash, key in pending
+        if cachedRender(cacheDir(host, info), key) is None and sourceHash not in _sources
+    })
+    for sourcePath, content in fetchSources(host, needed).items():
+        _sources[hashlib.sha256(content).hexdigest()] = content
+
+    for info, plan, link, sourcePath, targetPath, sourceHash, key in pending:
+        content = cachedRender(cacheDir(host, info), key)
+        if content is None:
+            if sourceHash not in _sources:
+                print(f"Warning: Could not read template '{sourcePath}', keeping the previous file.")
+                keepPrevious(info, plan, link, snapshot)
+                continue
+            try:
+                content = render(_sources[sourceHash].decode(), templateContext(host, chobolo, info))
+            except Exception as error:
+                print(f"Warning: Could not render template '{sourcePath}', keeping the previous file: {error}")
+                keepPrevious(info, plan, link, snapshot)
+                continue
+            storeRender(cacheDir(host, info), key, content)
+        addTemplate(info, plan, link, sourcePath, targetPath, key, content, snapshot)
+    for directory, keys in current.items():
+        pruneCache(directory, keys)
+
+
+def addTemplate(info, plan, link, sourcePath, targetPath, key, content, snapshot):
+    outputHash = hashlib.sha256(content.encode()).hexdigest()
+    destRel = link.get('to') or link.get('from')
+    targetState = snapshot['fs'].get(targetPath)
+    isFile = targetState is not None and targetState.type == 'f'
+    plan['applied'].append({
+        'source': link.get('from'), 'path': link.get('from') if destRel == '.' else destRel,
+        'open': False, 'template': True, 'hash': outputHash, 'input': key, 'managed_files': [],
+    })
+    plan['written'].append((targetPath, sourcePath))
+    if isFile and snapshot['hashes'].get(targetPath) == outputHash:
+        return
+    previous = plan['previous'].get(targetPath)
+    ours = isFile and previous is not None and snapshot['hashes'].get(targetPath) == previous
+    stagePath = f"{os.path.dirname(info['stateFile'])}/.dotfiles_{info['name']}.{outputHash[:16]}"
+    plan['writes'].append(('install', stagePath, targetPath, ours))
+    plan['uploads'][stagePath] = content
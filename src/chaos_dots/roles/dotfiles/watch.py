@@ -0,0 +1,177 @@
+import argparse
+import ctypes
+import ctypes.util
+import getpass
+import os
+import select
+import shlex
+import struct
+import subprocess
+import sys
+import time
+
+from pyinfra.connectors.local import LocalConnector
+
+from .apply import APPLY_SCRIPT, renderManifest
+from .backups import STORE_FUNCTIONS
+from .chobolo import choboloVars, loadChobolo
+from .dotfiles_new import planHost
+from .snapshot import describeDot
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class LocalHost:
+    name = '@local'
+    connector_cls = LocalConnector
+    data = {}
+
+    def get_fact(self, fact, *args, **kwargs):
+        instance = fact()
+        result = subprocess.run(['sh', '-c', instance.command(*args)], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        return instance.process(result.stdout.splitlines())
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def addTree(self, top, owner):
+        for dirPath, dirNames, _ in os.walk(top):
+            dirNames[:] = [name for name in dirNames if name != '.git']
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirPath), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = (dirPath, owner)
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return None
+        buffer = os.read(self.fd, 64 * 1024)
+        events, offset = [], 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+
+def watchedDotfiles(dotfiles, user):
+    return tuple(dot for dot in dotfiles if dot.get('user') == user and os.path.isdir(describeDot(dot)['loc']))
+
+
+def applyRepoLocally(repoPlan):
+    stateFile = repoPlan['stateFile']
+    stateDir = os.path.dirname(stateFile)
+    os.makedirs(stateDir, exist_ok=True)
+    failed = []
+    if repoPlan['manifest']:
+        for stagePath, content in repoPlan.get('uploads', {}).items():
+            with open(stagePath, 'w') as staged:
+                staged.write(content)
+        manifestPath = f"{stateDir}/.dotfiles_{repoPlan['name']}.manifest"
+        with open(manifestPath, 'w') as manifestFile:
+            manifestFile.write(renderManifest(repoPlan['manifest']))
+        script = STORE_FUNCTIONS + APPLY_SCRIPT.format(manifest=shlex.quote(manifestPath))
+        result = subprocess.run(['sh', '-c', script], capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            status, _, entry = line.partition('\t')
+            if status == 'failed':
+                failed.append(entry.replace('\t', ' ').strip())
+        if result.returncode != 0 and not failed:
+            failed.append(f"apply the manifest: {result.stderr.strip() or f'exit status {result.returncode}'}")
+    if not failed:
+        with open(stateFile, 'w') as state:
+            state.write(repoPlan['state'])
+    return failed
+
+
+def syncOnce(host, dotfiles, dirty, chobolo=None):
+    hostPlan = planHost(None, host, dotfiles, dirty, chobolo, watching=True)
+    for repoPlan in hostPlan['repos']:
+        if repoPlan['status'] != 'planned':
+            continue
+        failed = applyRepoLocally(repoPlan)
+        changes = len(repoPlan['manifest'])
+        print(f"{repoPlan['name']}: applied {changes - len(failed)} of {changes} change(s).")
+        for entry in failed:
+            print(f"Warning: {repoPlan['name']}: failed to {entry}", file=sys.stderr)
+        if failed:
+            print(f"Warning: {repoPlan['name']}: state not recorded, the repo is planned again on the next change.", file=sys.stderr)
+
+
+def waitForChanges(inotify, debounce):
+    dirty, deadline = set(), None
+    while True:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        events = inotify.read(timeout)
+        if events is None:
+            return dirty
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                dirty.update(owner for _, owner in inotify.watches.values())
+                continue
+            if wd not in inotify.watches:
+                continue
+            dirPath, owner = inotify.watches[wd]
+            if mask & IN_IGNORED:
+                del inotify.watches[wd]
+                continue
+            if name == '.git' or name.startswith('.git/'):
+                continue
+            dirty.add(owner)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                inotify.addTree(os.path.join(dirPath, name), owner)
+        deadline = time.monotonic() + debounce
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='chaos-dots-watch', description="Relink dotfiles as their checkouts change.")
+    parser.add_argument('chobolo', help="path to the chobolo file with the dotfiles entries")
+    parser.add_argument('--debounce', type=float, default=0.5, help="seconds to wait for changes to settle")
+    args = parser.parse_args(argv)
+
+    user = getpass.getuser()
+    dotfiles = watchedDotfiles(loadChobolo(args.chobolo), user)
+    if not dotfiles:
+        print(f"No cloned dotfiles repos for user '{user}' in {args.chobolo}.", file=sys.stderr)
+        return 1
+
+    host = LocalHost()
+    inotify = Inotify()
+    locs = [describeDot(dot)['loc'] for dot in dotfiles]
+    for loc in locs:
+        inotify.addTree(loc, loc)
+    chobolo = choboloVars(args.chobolo)
+    syncOnce(host, dotfiles, set(locs), chobolo)
+    print(f"Watching {len(locs)} dotfiles repo(s) for '{user}'.")
+
+    try:
+        while True:
+            dirty = waitForChanges(inotify, args.debounce)
+            if dirty:
+                syncOnce(host, dotfiles, dirty, chobolo)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+import shlex
+import subprocess
+
+from chaos_dots.roles.dotfiles import localfs
+from chaos_dots.roles.dotfiles.apply import APPLY_SCRIPT, renderManifest
+from chaos_dots.roles.dotfiles.backups import STORE_FUNCTIONS, indexPath, parseIndex, pruneEntry, storeDir
+from chaos_dots.roles.dotfiles.chobolo import normaliseDotfiles
+from chaos_dots.roles.dotfiles.gitsync import cloneRepos
+from chaos_dots.roles.dotfiles.snapshot import buildSnapshotScript, buildSnapshotScripts, mergeSnapshot, parseSnapshot, snapshotRequest
+
+QUOTED = "it's \"quoted\" $HOME `x`"
+NEWLINE = "evil\nT\tforged\tf\t"
+
+
+class ShellHost:
+    name = 'shell'
+
+    def get_fact(self, fact, *args, **kwargs):
+        command = fact().command(*args)
+        result = subprocess.run(['sh', '-c', command], capture_output=True, text=True)
+        return result.stdout
+
+
+def git(*args):
+    subprocess.run(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args], check=True, capture_output=True)
+
+
+def makeRepo(path, files):
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(f"{path}/{name}"), exist_ok=True)
+        with open(f"{path}/{name}", 'w') as handle:
+            handle.write(content)
+    git('init', '-q', '-b', 'main', path)
+    git('-C', path, 'add', '-A')
+    git('-C', path, 'commit', '-q', '-m', 'init')
+
+
+def repoInfo(home, name='dots'):
+    # An empty user runs git directly instead of through sudo.
+    return {
+        'user': '', 'name': name, 'home': home,
+        'loc': f"{home}/.dotfiles/chaos/{name}",
+        'stateFile': f"{home}/.local/state/chaos/dotfiles_{name}",
+    }
+
+
+def dotEntry(url, links=()):
+    return normaliseDotfiles([{'user': 'tester', 'url': url, 'links': list(links)}])[0]
+
+
+def runShell(script):
+    return subprocess.run(['sh', '-c', script], capture_output=True, text=True)
+
+
+def applyManifest(tmp_path, manifest):
+    manifestPath = f"{tmp_path}/manifest"
+    with open(manifestPath, 'w') as handle:
+        handle.write(renderManifest(manifest))
+    return runShell(STORE_FUNCTIONS + APPLY_SCRIPT.format(manifest=shlex.quote(manifestPath)))
+
+
+def testSnapshotQuotedPaths(tmp_path):
+    home = str(tmp_path)
+    info = repoInfo(home)
+    makeRepo(info['loc'], {f"my conf/{QUOTED}": "a\n", "rc file": "b\n"})
+    with open(f"{info['loc']}/my conf/{NEWLINE}", 'w'):
+        pass
+    target = f"{home}/.config/my app"
+    os.makedirs(target)
+    os.symlink(f"{info['loc']}/my conf/{QUOTED}", f"{target}/{QUOTED}")
+    os.symlink(f"{info['loc']}/my conf/{NEWLINE}", f"{target}/{NEWLINE}")
+    os.symlink(f"{info['loc']}/rc file", f"{home}/.rc file")
+    dot = dotEntry('https://example.com/dots.git', [
+        {'from': 'my conf', 'to': '.config/my app', 'open': True},
+        {'from': 'rc file', 'to': '.rc file'},
+    ])
+    request = snapshotRequest([(info, dot['links'])])
+
+    result = runShell(buildSnapshotScript(request))
+    assert result.returncode == 0, result.stderr
+    shell = parseSnapshot(result.stdout)
+    local = parseSnapshot(localfs.snapshotLines(request))
+
+    assert shell['open'][f"{info['loc']}/my conf"] == [(QUOTED, 'f')]
+    assert shell['fs'][f"{target}/{QUOTED}"].link == f"{info['loc']}/my conf/{QUOTED}"
+    assert shell['fs'][f"{home}/.rc file"].link == f"{info['loc']}/rc file"
+    assert 'forged' not in shell['fs']
+    assert len(shell['commits'][info['loc']]) == 40
+    for key in ('repos', 'commits', 'open', 'fs', 'states'):
+        assert shell[key] == local[key], key
+
+
+def testSnapshotChunks(tmp_path):
+    home = str(tmp_path)
+    info = repoInfo(home)
+    makeRepo(info['loc'], {f"file {i}": f"{i}\n" for i in range(200)})
+    for i in range(0, 200, 2):
+        os.symlink(f"{info['loc']}/file {i}", f"{home}/.file {i}")
+    dot = dotEntry('https://example.com/dots.git', [{'from': f"file {i}", 'to': f".file {i}"} for i in range(200)])
+    request = snapshotRequest([(info, dot['links'])])
+
+    scripts = buildSnapshotScripts(request, limit=2048)
+    assert len(scripts) > 1
+    chunked = parseSnapshot(())
+    for script in scripts:
+        result = runShell(script)
+        assert result.returncode == 0, result.stderr
+        mergeSnapshot(chunked, parseSnapshot(result.stdout))
+    whole = parseSnapshot(runShell(buildSnapshotScript(request)).stdout)
+
+    assert len(chunked['fs']) == 100
+    for key in ('users', 'repos', 'commits', 'fs', 'states'):
+        assert chunked[key] == whole[key], key
+
+
+def testBackupDiscardPrune(tmp_path):
+    home = str(tmp_path)
+    store = storeDir(home)
+    edited, untouched = f"{home}/edited '\"file\"", f"{home}/untouched file"
+    linked = f"{home}/.config/some link"
+    for path, content in ((edited, "mine\n"), (untouched, "ours\n")):
+        with open(path, 'w') as handle:
+            handle.write(content)
+    os.makedirs(os.path.dirname(linked))
+    os.symlink("/nowhere", linked)
+    oursHash = subprocess.run(['sha256sum', untouched], capture_output=True, text=True).stdout[:64]
+
+    result = applyManifest(tmp_path, [
+        ('backup', linked, store),
+        ('discard', edited, store, '0' * 64),
+        ('discard', untouched, store, oursHash),
+    ])
+    assert result.returncode == 0, result.stdout
+    assert not any(os.path.lexists(path) for path in (linked, edited, untouched))
+    with open(indexPath(home)) as handle:
+        entries = parseIndex(handle.read())
+    assert [(entry['path'], entry['kind']) for entry in entries] == [(linked, 'l'), (edited, 'f')]
+    assert entries[0]['ref'] == "/nowhere"
+    assert os.path.isfile(f"{store}/objects/{entries[1]['ref']}")
+
+    with open(indexPath(home)) as handle:
+        prune = pruneEntry(home, handle.read(), {'keep': 5, 'maxDays': 0, 'maxBytes': 1 << 30})
+    assert prune == ('prune', store, " ".join(entry['id'] for entry in entries))
+    result = applyManifest(tmp_path, [prune])
+    assert result.returncode == 0, result.stdout
+    with open(indexPath(home)) as handle:
+        assert handle.read() == ""
+    assert os.listdir(f"{store}/objects") == []
+
+
+def testFailedClone(tmp_path, capsys):
+    remote = f"{tmp_path}/remote"
+    makeRepo(remote, {"rc": "x\n"})
+    good, bad = repoInfo(f"{tmp_path}/home", 'good'), repoInfo(f"{tmp_path}/home", 'bad')
+    clones = [
+        (good, dotEntry(remote)),
+        (bad, dotEntry(f"{tmp_path}/missing.git")),
+    ]
+
+    cloned, failed = cloneRepos(ShellHost(), clones, set())
+
+    assert cloned == {good['loc']}
+    assert os.path.isfile(f"{good['loc']}/rc")
+    assert list(failed) == [bad['loc']]
+    assert 'missing.git' in failed[bad['loc']]
+    assert f"Error: Could not clone {bad['loc']}" in capsys.readouterr().out